@@ -0,0 +1,209 @@
+#
+# cached-feature fast path for the 'attack' mode
+# -------------------------------
+#
+# in the attack mode only the adversary head is trained and the ranker stays frozen, therefore:
+#   1. the frozen ranker runs once over the training data and stores the [CLS] vectors of the positive and negative
+#      documents together with their protected labels in a memory-mapped file
+#   2. the adversary is trained for many epochs on the stored vectors, without BERT forward/backward passes
+#
+
+import os
+import glob
+import json
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+from allennlp.nn.util import move_to_device
+
+from multiprocess_input_pipeline import *
+from evaluation import queue_batches
+from model import GroupedAdversaryProbes
+
+
+#
+# split: "train" (positive and negative documents of the training triples) or "validation" (validation tuples)
+#
+def extract_cls_features(model, cuda_device, config, logger, store_folder, split="train") -> Tuple[np.memmap, np.ndarray]:
+    _features_path = os.path.join(store_folder, "attack-%s-features.float32" % split)
+    _labels_path = os.path.join(store_folder, "attack-%s-labels.npy" % split)
+    _shape_path = os.path.join(store_folder, "attack-%s-features.json" % split)
+
+    if split == "train":
+        _max_batch_count = config["max_training_batch_count"]
+        _files = glob.glob(config.get("train_tsv"))
+        _loader = multiprocess_training_loader
+        _fields = [("doc_pos_tokens", "protected_label_pos"), ("doc_neg_tokens", "protected_label_neg")]
+    else:
+        _max_batch_count = config["max_evaluation_batch_count"]
+        _files = glob.glob(config["%s_tsv" % split])
+        _loader = multiprocess_validation_loader
+        _fields = [("doc_tokens", "protected_label")]
+
+    _queue, _processes, _exit, _loader_stats = get_multiprocess_batch_queue("attack-feature-batches-" + split,
+                                                                            _loader,
+                                                                            files=_files,
+                                                                            conf=config,
+                                                                            _logger=logger)
+    model.eval()
+    _labels = []
+    _feature_count = 0
+    try:
+        with open(_features_path, "wb") as fw, torch.no_grad():
+            for batch_num, batch in enumerate(queue_batches(_queue, len(_files), _loader_stats)):
+                if batch_num >= _max_batch_count and _max_batch_count != -1:
+                    break
+                if cuda_device != -1:
+                    batch = move_to_device(batch, cuda_device)
+
+                for _doc_field, _label_field in _fields:
+                    _cls_output = model.encode_cls(batch["query_tokens"], batch[_doc_field])
+                    fw.write(_cls_output.float().cpu().numpy().tobytes())
+                    _labels.append(batch[_label_field].cpu().numpy())
+                    _feature_count += _cls_output.size(0)
+
+                if batch_num % config["log_interval"] == 0:
+                    logger.info('ATTACK FEATURES | %s | %5d batches | %d vectors' % (split, batch_num, _feature_count))
+    finally:
+        _exit.set()  # allow sub-processes to exit
+        for proc in _processes:
+            if proc.is_alive():
+                proc.terminate()
+
+    _labels = np.concatenate(_labels).astype(np.int64)
+    np.save(_labels_path, _labels)
+    with open(_shape_path, "w") as fw:
+        json.dump({"count": _feature_count, "size": model._embedding_size}, fw)
+    logger.info('ATTACK FEATURES FINISHED | %s | %d vectors stored in %s' % (split, _feature_count, _features_path))
+
+    _features = np.memmap(_features_path, dtype=np.float32, mode="r", shape=(_feature_count, model._embedding_size))
+    return _features, _labels
+
+#
+# trains the adversary on the stored vectors, chunks of the memory-mapped file are read in a random order and
+# shuffled in memory
+#
+def train_adversary_on_features(model, features, labels, optimizer_adv, criterion_adversary, cuda_device, config,
+                                logger, tb_writer) -> int:
+    _epochs = int(config.get("attack_cached_epochs", 20))
+    _batch_size = int(config.get("attack_cached_batch_size", 1024))
+    _chunk_size = int(config.get("attack_cached_chunk_size", 262144))
+    _device = torch.device("cuda:%d" % cuda_device if cuda_device != -1 else "cpu")
+
+    model.adversary_net.train()
+    batch_cnt_global = 0
+    for epoch in range(_epochs):
+        _start_time = time.perf_counter()
+        _loss_sum = 0.0
+        _correct = 0
+        _chunk_starts = np.random.permutation(np.arange(0, len(labels), _chunk_size))
+        for _chunk_start in _chunk_starts:
+            _chunk_features = torch.from_numpy(np.array(features[_chunk_start:_chunk_start + _chunk_size])).to(_device)
+            _chunk_labels = torch.from_numpy(labels[_chunk_start:_chunk_start + _chunk_size]).to(_device)
+            _order = torch.randperm(_chunk_labels.size(0), device=_device)
+            for _batch_start in range(0, _order.size(0), _batch_size):
+                _batch_indices = _order[_batch_start:_batch_start + _batch_size]
+
+                optimizer_adv.zero_grad()
+                adversary_lprobs = model.adversary_forward(_chunk_features[_batch_indices])
+                loss_adv = criterion_adversary(adversary_lprobs, _chunk_labels[_batch_indices])
+                loss_adv.backward()
+                torch.nn.utils.clip_grad_norm_(model.adversary_net.parameters(), max_norm=1.0)
+                optimizer_adv.step()
+
+                _loss_sum += loss_adv.item() * _batch_indices.size(0)
+                _correct += int((adversary_lprobs.argmax(dim=-1) == _chunk_labels[_batch_indices]).sum())
+                batch_cnt_global += 1
+
+        _elapsed = time.perf_counter() - _start_time
+        _loss = _loss_sum / float(len(labels))
+        _accuracy = _correct / float(len(labels))
+        tb_writer.add_scalar("train/loss", _loss, batch_cnt_global)
+        tb_writer.add_scalar("train/adv_accuracy", _accuracy, batch_cnt_global)
+        logger.info('| ATTACK (cached features) | epoch %3d | %5d batches | %.1f batches/s | avg. loss %.5f | accuracy %.4f' %
+                    (epoch, batch_cnt_global, (len(labels) / float(_batch_size)) / _elapsed, _loss, _accuracy))
+
+    return batch_cnt_global
+
+#
+# multi-probe leakage estimate: trains K independent adversary heads (all combinations of the configured hidden sizes 
+# and seeds) on the same stored vectors, the heads of each hidden size are computed as one grouped operation.
+# returns the validation accuracy of every probe, the dummy baseline and the mean / variance over the probes
+#
+def train_probes_on_features(features, labels, validation_features, validation_labels, config, cuda_device,
+                             logger) -> Dict[str, any]:
+    _epochs = int(config.get("attack_cached_epochs", 20))
+    _batch_size = int(config.get("attack_cached_batch_size", 1024))
+    _chunk_size = int(config.get("attack_cached_chunk_size", 262144))
+    _seeds = config["attack_probe_seeds"]
+    _device = torch.device("cuda:%d" % cuda_device if cuda_device != -1 else "cpu")
+
+    probe_groups = [GroupedAdversaryProbes(features.shape[1], _hidden_size, _seeds).to(_device)
+                    for _hidden_size in config["attack_probe_hidden_sizes"]]
+    _parameters = [_param for _group in probe_groups for _param in _group.parameters()]
+    # adam updates every element independently, so the probes do not influence each other
+    optimizer_probes = torch.optim.Adam(_parameters, lr=config["param_group_adversary_learning_rate"],
+                                        weight_decay=config["param_group_adversary_weight_decay"],
+                                        betas=(0.9, 0.999), eps=0.00001)
+
+    for epoch in range(_epochs):
+        _start_time = time.perf_counter()
+        _loss_sum = 0.0
+        _chunk_starts = np.random.permutation(np.arange(0, len(labels), _chunk_size))
+        for _chunk_start in _chunk_starts:
+            _chunk_features = torch.from_numpy(np.array(features[_chunk_start:_chunk_start + _chunk_size])).to(_device)
+            _chunk_labels = torch.from_numpy(labels[_chunk_start:_chunk_start + _chunk_size]).to(_device)
+            _order = torch.randperm(_chunk_labels.size(0), device=_device)
+            for _batch_start in range(0, _order.size(0), _batch_size):
+                _batch_indices = _order[_batch_start:_batch_start + _batch_size]
+                _batch_labels = _chunk_labels[_batch_indices]
+
+                optimizer_probes.zero_grad()
+                loss = 0
+                for _group in probe_groups:
+                    _lprobs = _group(_chunk_features[_batch_indices]) # (probes, batch, 2)
+                    # sum of the mean losses of the probes
+                    loss = loss + torch.nn.functional.nll_loss(_lprobs.reshape(-1, 2), 
+                                                               _batch_labels.repeat(_group.probe_count),
+                                                               reduction="sum") / _batch_labels.size(0)
+                loss.backward()
+                optimizer_probes.step()
+                _loss_sum += loss.item() * _batch_indices.size(0)
+
+        logger.info('| ATTACK PROBES | epoch %3d | %.1f s | avg. loss per probe %.5f' % 
+                    (epoch, time.perf_counter() - _start_time, 
+                     _loss_sum / float(len(labels) * len(_seeds) * len(probe_groups))))
+
+    #
+    # accuracy on the validation vectors
+    #
+    _correct = [np.zeros(len(_seeds)) for _group in probe_groups]
+    with torch.no_grad():
+        for _chunk_start in range(0, len(validation_labels), _chunk_size):
+            _chunk_features = torch.from_numpy(np.array(validation_features[_chunk_start:_chunk_start + _chunk_size])).to(_device)
+            _chunk_labels = torch.from_numpy(validation_labels[_chunk_start:_chunk_start + _chunk_size]).to(_device)
+            for _group_i, _group in enumerate(probe_groups):
+                _predictions = _group(_chunk_features).argmax(dim=-1) # (probes, batch)
+                _correct[_group_i] += (_predictions == _chunk_labels.unsqueeze(0)).sum(dim=1).cpu().numpy()
+
+    _probes = []
+    for _group_i, _group in enumerate(probe_groups):
+        for _seed_i, _seed in enumerate(_seeds):
+            _probes.append({"hidden_size": _group.hidden_size, "seed": _seed,
+                            "adv_accuracy": _correct[_group_i][_seed_i] / float(len(validation_labels))})
+    _accuracies = [_probe["adv_accuracy"] for _probe in _probes]
+    results = {"probes": _probes,
+               "adv_accuracy_mean": float(np.mean(_accuracies)),
+               "adv_accuracy_var": float(np.var(_accuracies)),
+               "adv_accuracy_max": float(np.max(_accuracies)),
+               "adv_accuracy_dummybaseline": 1 - (np.sum(validation_labels) / float(len(validation_labels)))}
+    
+    for _probe in _probes:
+        logger.info('| ATTACK PROBES | hidden size %4d | seed %5d | accuracy %.4f' % 
+                    (_probe["hidden_size"], _probe["seed"], _probe["adv_accuracy"]))
+    logger.info('| ATTACK PROBES | accuracy mean %.4f var %.6f max %.4f | dummy baseline %.4f' % 
+                (results["adv_accuracy_mean"], results["adv_accuracy_var"], results["adv_accuracy_max"], 
+                 results["adv_accuracy_dummybaseline"]))
+    return results
@@ -0,0 +1,144 @@
+#
+# background validation on weight snapshots
+# -------------------------------
+#
+# the validation during training (inference, metrics, best-model selection and tensorboard logging) runs in a
+# separate process on snapshots of the model weights, while the training continues:
+#   1. submit() copies the weights to the cpu and queues them for the validation process. at most max_in_flight
+#      snapshots are queued or evaluated at a time, a snapshot that waits for a free slot is replaced (dropped) by a
+#      newer one
+#   2. poll() returns the results that arrived since the last call, to feed the lr scheduler and early stopping
+#   3. finish() validates the waiting snapshot, waits for all results and stops the validation process
+#
+
+import queue
+from typing import Dict, List
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.tensorboard import SummaryWriter
+
+from model import get_model_args, create_model_from_args
+from evaluation import validate_and_store_best, wait_for_saved_results, close_query_parallel_inference
+from utils import get_logger_to_file
+
+
+#
+# validation process: one job (model state, epoch, batch count) after the other, until the None job.
+# the metrics of each job are sent back, None signals a failure
+#
+def background_validation_process(model_args, config, run_folder, cuda_device, validation_set, always_store_best,
+                                  jobs_queue, results_queue):
+    if config.get("background_validation_threads", -1) > 0:
+        torch.set_num_threads(config["background_validation_threads"])
+
+    logger = get_logger_to_file(run_folder, "background-validation", "log-validation.txt")
+    tb_writer = SummaryWriter(run_folder, filename_suffix=".validation")
+
+    model = create_model_from_args(model_args)
+    if cuda_device != -1:
+        model.cuda(cuda_device)
+
+    best_result_info = None
+    try:
+        while True:
+            _job = jobs_queue.get()
+            if _job is None:
+                break
+            model_state, epoch, batch_cnt_global = _job
+            model.load_state_dict(model_state)
+            del model_state, _job  # releases the shared memory of the snapshot
+
+            logger.info("Background validation of epoch %d batch %d" % (epoch, batch_cnt_global))
+            _result_info, best_result_info = validate_and_store_best(model, config, logger, run_folder, cuda_device,
+                                                                     validation_set, tb_writer, best_result_info,
+                                                                     epoch, batch_cnt_global,
+                                                                     always_store_best=always_store_best)
+            results_queue.put({"metrics_avg": _result_info["metrics_avg"], "epoch": epoch,
+                               "batch_cnt_global": batch_cnt_global})
+        wait_for_saved_results()
+
+    except BaseException as e:
+        logger.exception('[background_validation] Got exception: %s' % str(e))
+        results_queue.put(None)
+        raise e
+
+    finally:
+        # the process exit would wait for the (non-daemon) inference workers
+        close_query_parallel_inference()
+        tb_writer.close()
+
+
+class BackgroundValidator():
+    def __init__(self, model, config, logger, run_folder, cuda_device, validation_set, always_store_best=False):
+        self.logger = logger
+        self.max_in_flight = int(config.get("background_validation_max_in_flight", 2))
+        self.in_flight = 0
+        self.dropped_count = 0
+        self._waiting = None  # (model state, epoch, batch count) of the snapshot that waits for a free slot
+
+        _context = mp.get_context("spawn")
+        self._jobs_queue = _context.Queue()
+        self._results_queue = _context.Queue()
+        # not a daemon: the validation starts its own loader processes
+        self._process = _context.Process(target=background_validation_process,
+                                         args=(get_model_args(model), config, run_folder, cuda_device,
+                                               validation_set, always_store_best,
+                                               self._jobs_queue, self._results_queue))
+        self._process.start()
+
+    def submit(self, model, epoch, batch_cnt_global):
+        # the copy is moved to shared memory when it is queued
+        _model_state = {_name: _tensor.detach().to("cpu", copy=True) for _name, _tensor in model.state_dict().items()}
+        if self._waiting is not None:
+            self.dropped_count += 1
+            self.logger.warning("Background validation: snapshot of epoch %d batch %d dropped (%d in flight)" %
+                                (self._waiting[1], self._waiting[2], self.in_flight))
+        self._waiting = (_model_state, epoch, batch_cnt_global)
+        self._send_waiting()
+
+    def poll(self) -> List[Dict[str, any]]:
+        results = []
+        while self.in_flight > 0:
+            try:
+                results.append(self._received(self._results_queue.get_nowait()))
+            except queue.Empty:
+                break
+        self._send_waiting()
+        return results
+
+    def finish(self) -> List[Dict[str, any]]:
+        results = self.poll()
+        while self.in_flight > 0:
+            results.append(self._wait_for_result())
+            self._send_waiting()
+        self._jobs_queue.put(None)
+        self._process.join()
+        self.logger.info("Background validation finished, %d snapshots dropped" % self.dropped_count)
+        return results
+
+    def terminate(self):
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def _send_waiting(self):
+        if self._waiting is not None and self.in_flight < self.max_in_flight:
+            self._jobs_queue.put(self._waiting)
+            self._waiting = None
+            self.in_flight += 1
+
+    def _wait_for_result(self):
+        while True:
+            try:
+                return self._received(self._results_queue.get(timeout=10))
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise Exception("Background validation process exited with code %s" % str(self._process.exitcode))
+
+    def _received(self, result):
+        if result is None:
+            raise Exception("Background validation failed, see log-validation.txt")
+        self.in_flight -= 1
+        self.logger.info("Background validation result of epoch %d batch %d: %s" %
+                         (result["epoch"], result["batch_cnt_global"], str(result["metrics_avg"])))
+        return result
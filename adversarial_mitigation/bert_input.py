@@ -0,0 +1,54 @@
+from typing import Tuple
+
+import torch
+
+
+#
+# builds the [CLS] query [SEP] document [SEP] input of BERT (token ids, padding mask, segment mask) for a batch
+#   - query and document are padded with 0, the output stays on their device
+#   - we assume that the length of query (+2) never exceeds <max_input_length>, therefore only the document is 
+#     truncated (leaving space for the last [SEP])
+#   - with dynamic_input_length, the sequence length is the longest input of the batch rounded up to a multiple of 
+#     <input_length_multiple> (at most <max_input_length>), otherwise always <max_input_length>
+#   - does not depend on the model (nor on allennlp), so it can also be called in the loader processes and at serving
+#
+def prepare_bert_input(query: torch.Tensor, document: torch.Tensor, cls_token_id: int, sep_token_id: int, 
+                       max_input_length: int = 512, dynamic_input_length: bool = False, 
+                       input_length_multiple: int = 1) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    bsz = document.size(0)
+    query = query.long()
+    document = document.long()
+    seg_1_value = 0
+    seg_2_value = 1
+
+    _query_lengths = (query != 0).sum(dim=1, keepdim=True)
+    _doc_lengths = (document != 0).sum(dim=1, keepdim=True)
+    _doc_start = _query_lengths + 2
+    _doc_lengths = torch.min(_doc_lengths, max_input_length - 1 - _doc_start)
+    _doc_end = _doc_start + _doc_lengths # position of the last [SEP]
+
+    if dynamic_input_length:
+        _input_length = int(_doc_end.max()) + 1
+        _input_length = ((_input_length + input_length_multiple - 1) // input_length_multiple) * input_length_multiple
+        max_input_length = min(_input_length, max_input_length)
+
+    _positions = torch.arange(max_input_length, device=document.device).unsqueeze(0).expand(bsz, -1)
+    _query_mask = (_positions >= 1) & (_positions < _query_lengths + 1)
+    _doc_mask = (_positions >= _doc_start) & (_positions < _doc_end)
+
+    _query_offsets = (_positions - 1).clamp(0, query.size(1) - 1)
+    _doc_offsets = (_positions - _doc_start).clamp(0, document.size(1) - 1)
+    
+    tok_seq = torch.zeros((bsz, max_input_length), dtype=torch.long, device=document.device)
+    tok_seq = torch.where(_query_mask, query.gather(1, _query_offsets), tok_seq)
+    tok_seq = torch.where(_doc_mask, document.gather(1, _doc_offsets), tok_seq)
+    tok_seq[:, 0] = cls_token_id
+    tok_seq.scatter_(1, _query_lengths + 1, sep_token_id)
+    tok_seq.scatter_(1, _doc_end, sep_token_id)
+
+    seg_mask = torch.full((bsz, max_input_length), seg_1_value, dtype=torch.long, device=document.device)
+    seg_mask[(_positions >= _doc_start) & (_positions <= _doc_end)] = seg_2_value
+
+    pad_mask = (tok_seq != 0).long()
+    
+    return tok_seq, pad_mask, seg_mask
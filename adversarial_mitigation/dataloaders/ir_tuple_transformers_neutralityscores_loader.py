@@ -1,7 +1,8 @@
 # based on: https://github.com/allenai/allennlp/blob/master/allennlp/data/dataset_readers/seq2seq.py
 
-from typing import Dict, List, Set
+from typing import Dict, List, Set, Tuple
 from typing import Callable
+from collections import OrderedDict
 import logging
 import sys
 import numpy as np
@@ -20,6 +21,31 @@ from transformers import PreTrainedTokenizer
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+class LRUCache():
+    """
+    least-recently-used cache with a fixed number of entries, counting hits and misses
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
 class IrTupleTransformersNeutralityScoresDatasetReader(DatasetReader):
     def __init__(self,
                  transformers_tokenizer: PreTrainedTokenizer,
@@ -29,7 +55,10 @@ class IrTupleTransformersNeutralityScoresDatasetReader(DatasetReader):
                  max_query_length:int = -1,
                  lazy: bool = False,
                  preprocess: Callable = None,
-                 doc_neutrality=None
+                 doc_neutrality=None,
+                 cache_size: int = 0, # number of cached queries and documents (each), 0 to disable
+                 tuple_filter: Dict[str, Set[str]] = None, # query_id -> doc_ids to read, other tuples are skipped
+                 query_partition: Tuple[int, int] = None # (index, count): only the queries with query_id % count == index
                  ) -> None:
         super().__init__(lazy)
         #self._pre_tokenizer = WhitespaceTokenizer()
@@ -39,6 +68,12 @@ class IrTupleTransformersNeutralityScoresDatasetReader(DatasetReader):
         self._max_query_length = max_query_length
         self._preprocess = preprocess
         self.doc_neutrality = doc_neutrality               
+        self._tuple_filter = tuple_filter
+        self._query_partition = query_partition
+        
+        # token ids and neutrality scores of the already seen queries (by query_id) and documents (by doc_id)
+        self.query_cache = LRUCache(cache_size) if cache_size > 0 else None
+        self.doc_cache = LRUCache(cache_size) if cache_size > 0 else None
 
     @overrides
     def _read(self, file_path):
@@ -57,26 +92,46 @@ class IrTupleTransformersNeutralityScoresDatasetReader(DatasetReader):
                         sys.stdout.flush()
                         raise ConfigurationError("Invalid line format: %s (line number %d)" % (line, line_num + 1))
                     query_id, doc_id, query_sequence, doc_sequence = line_parts
-                    if self._preprocess != None:
-                        query_sequence = self._preprocess(query_sequence)
-                        doc_sequence = self._preprocess(doc_sequence)
+
+                    # skipped before the (expensive) neutrality scoring and tokenization
+                    if (self._query_partition is not None and 
+                        int(query_id) % self._query_partition[1] != self._query_partition[0]):
+                        continue
+                    if self._tuple_filter is not None and doc_id not in self._tuple_filter.get(query_id, ()):
+                        continue
+                    
+                    if self.query_cache is None:
+                        if self._preprocess != None:
+                            query_sequence = self._preprocess(query_sequence)
+                            doc_sequence = self._preprocess(doc_sequence)
+                        
+                        query_neutscore = self.doc_neutrality.get_neutrality(query_sequence.split(' '))
+                        doc_neutscore = self.doc_neutrality.get_neutrality(doc_sequence.split(' '))
                     
-                    query_neutscore = self.doc_neutrality.get_neutrality(query_sequence.split(' '))
-                    doc_neutscore = self.doc_neutrality.get_neutrality(doc_sequence.split(' '))
-                
-                    yield self.text_to_instance(query_id, doc_id, query_sequence, doc_sequence, query_neutscore, doc_neutscore)
+                        yield self.text_to_instance(query_id, doc_id, query_sequence, doc_sequence, 
+                                                    query_neutscore, doc_neutscore)
+                    else:
+                        query_tokenized, query_neutscore = self._get_cached(self.query_cache, query_id, query_sequence,
+                                                                            self._tokenize_query)
+                        doc_tokenized, doc_neutscore = self._get_cached(self.doc_cache, doc_id, doc_sequence,
+                                                                        self._tokenize_doc)
+                        
+                        yield self.tokenized_to_instance(query_id, doc_id, query_tokenized, doc_tokenized, 
+                                                         query_neutscore, doc_neutscore)
         except Exception as e: 
             sys.stdout.write(e)
             sys.stdout.flush()
 
-    @overrides
-    def text_to_instance(self, query_id:str, doc_id:str, query_sequence: str, doc_sequence: str, 
-                         query_neutscore: float, doc_neutscore: float) -> Instance:  # type: ignore
-        # pylint: disable=arguments-differ
+    def _get_cached(self, cache, text_id, sequence, tokenize_function):
+        _entry = cache.get(text_id)
+        if _entry is None:
+            if self._preprocess != None:
+                sequence = self._preprocess(sequence)
+            _entry = (tokenize_function(sequence), self.doc_neutrality.get_neutrality(sequence.split(' ')))
+            cache.put(text_id, _entry)
+        return _entry
 
-        query_id_field = MetadataField(int(query_id))
-        doc_id_field = MetadataField(doc_id)
-        
+    def _tokenize_query(self, query_sequence: str) -> List[int]:
         # dummy code to prevent empty queries
         if len(query_sequence.strip()) == 0:
             query_sequence = "@@UNKNOWN@@"
@@ -84,16 +139,31 @@ class IrTupleTransformersNeutralityScoresDatasetReader(DatasetReader):
         query_pre_tokenized = query_sequence.split()
         if self._max_query_length > -1:
             query_pre_tokenized = query_pre_tokenized[:self._max_query_length]
-        query_tokenized = self._transformers_tokenizer(' '.join(query_pre_tokenized),
-                                                       truncation = True,
-                                                       add_special_tokens = self._add_special_tokens)["input_ids"]
-        
+        return self._transformers_tokenizer(' '.join(query_pre_tokenized),
+                                            truncation = True,
+                                            add_special_tokens = self._add_special_tokens)["input_ids"]
+
+    def _tokenize_doc(self, doc_sequence: str) -> List[int]:
         doc_pre_tokenized = doc_sequence.split()
         if self._max_doc_length > -1:
             doc_pre_tokenized = doc_pre_tokenized[:self._max_doc_length]
-        doc_tokenized = self._transformers_tokenizer(' '.join(doc_pre_tokenized),
-                                                     truncation = True,
-                                                     add_special_tokens = self._add_special_tokens)["input_ids"]
+        return self._transformers_tokenizer(' '.join(doc_pre_tokenized),
+                                            truncation = True,
+                                            add_special_tokens = self._add_special_tokens)["input_ids"]
+
+    @overrides
+    def text_to_instance(self, query_id:str, doc_id:str, query_sequence: str, doc_sequence: str, 
+                         query_neutscore: float, doc_neutscore: float) -> Instance:  # type: ignore
+        # pylint: disable=arguments-differ
+
+        return self.tokenized_to_instance(query_id, doc_id, self._tokenize_query(query_sequence), 
+                                          self._tokenize_doc(doc_sequence), query_neutscore, doc_neutscore)
+
+    def tokenized_to_instance(self, query_id:str, doc_id:str, query_tokenized: List[int], doc_tokenized: List[int], 
+                              query_neutscore: float, doc_neutscore: float) -> Instance:
+
+        query_id_field = MetadataField(int(query_id))
+        doc_id_field = MetadataField(doc_id)
 
         query_field = ArrayField(np.array(query_tokenized))
         doc_field = ArrayField(np.array(doc_tokenized))
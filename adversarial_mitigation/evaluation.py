@@ -1,7 +1,11 @@
 import os
 import copy
+import queue
+import atexit
 import time
 import glob
+import itertools
+import concurrent.futures
 from typing import Dict, Tuple, List
 import pdb
 import numpy as np
@@ -16,7 +20,9 @@ from sklearn.metrics import accuracy_score
 
 from multiprocess_input_pipeline import *
 from utils import *
+from model import get_cpu_inference_model, get_model_args, create_model_from_args
 from fairness_measurement.metrics_fairness import FaiRRMetricHelper
+from metrics_utility import ranks_in_groups, cumsum_in_groups, argsort_in_groups
 
 METRICS = {'map', 'ndcg_cut', 'recip_rank', 'P', 'recall'}
 
@@ -116,50 +122,146 @@ def compute_metrics_from_file(evaluator, path_to_candidate):
     
     return result_info, qry_doc_relscores
 
-def compute_metrics_at_cutoff(evaluator, path_to_candidate, reference_set_rank, reference_set_tuple,
-                              reference_set_cutoff):
+#
+# per-query arrays of the candidate set (BM25), computed once per reference set and kept for the next evaluations
+#
+REFERENCE_SET_ARRAYS_CACHE = {}
+
+def get_reference_set_arrays(reference_set_rank, reference_set_tuple):
+    _cached = REFERENCE_SET_ARRAYS_CACHE.get(id(reference_set_tuple))
+    if _cached is not None and _cached[0] is reference_set_tuple:
+        return _cached[1]
+
+    _qids = list(reference_set_tuple.keys())
+    _lengths = np.array([len(reference_set_tuple[qid]) for qid in _qids], dtype=np.int64)
+    _query_index = np.repeat(np.arange(len(_qids)), _lengths)
+    # per query: doc id -> row of the candidate arrays (the last one, if a document occurs several times)
+    _doc_rows = []
+    _row = 0
+    for qid in _qids:
+        _doc_rows.append({docid: _row + _i for _i, (docid, _) in enumerate(reference_set_tuple[qid])})
+        _row += len(reference_set_tuple[qid])
+    _arrays = {"qids": _qids,
+               "qid_index": {qid: _i for _i, qid in enumerate(_qids)},
+               "doc_rows": _doc_rows,
+               "query_index": _query_index,
+               "position": ranks_in_groups(_query_index),
+               "doc_id": np.array([docid for qid in _qids for docid, _ in reference_set_tuple[qid]], dtype=object),
+               "score": np.array([score for qid in _qids for _, score in reference_set_tuple[qid]], dtype=np.float64),
+               "rank": np.array([reference_set_rank[qid][docid] for qid in _qids 
+                                 for docid, _ in reference_set_tuple[qid]], dtype=np.int64),
+               # row of the same document that is found by doc_rows
+               "doc_row": np.array([_doc_rows[_i][docid] for _i, qid in enumerate(_qids) 
+                                    for docid, _ in reference_set_tuple[qid]], dtype=np.int64)}
+    REFERENCE_SET_ARRAYS_CACHE[id(reference_set_tuple)] = (reference_set_tuple, _arrays)
+    return _arrays
 
-    qids_to_ranked_candidate_docs = load_candidate(path_to_candidate)
+#
+# merges the model's ranking of the documents inside the cutoff with the rest of the candidate set (used up to 
+# reference_set_cutoff), with array operations over all queries. the result (incl. the order of the documents in 
+# the dicts) is the same as the one of the per-query procedure:
+#   1. the documents with a candidate rank <= cutoff, in the order of the model's scores, keep their scores
+#   2. the candidates not in 1., in candidate order, are added until there are cutoff documents
+#   3. the candidates from position <added documents> on are (re-)set
+#   the scores of 2. and 3. are the candidate scores, shifted below the lowest model score of 1.
+#
+# qids_to_ranked_candidate_docs: the model's ranking (dict[qid][docid] -> score, see ScoredTuples.to_candidate) or 
+# the path of its run file
+#
+def compute_metrics_at_cutoff(evaluator, qids_to_ranked_candidate_docs, reference_set_rank, reference_set_tuple,
+                              reference_set_cutoff, candidate_path_for_save=None):
+
+    if isinstance(qids_to_ranked_candidate_docs, str):
+        candidate_path_for_save = qids_to_ranked_candidate_docs + '.pruned'
+        qids_to_ranked_candidate_docs = load_candidate(qids_to_ranked_candidate_docs)
+    _reference = get_reference_set_arrays(reference_set_rank, reference_set_tuple)
+    _cutoff = reference_set_cutoff
+
+    # candidate queries in their order, as index of the reference set
+    _qids = list(qids_to_ranked_candidate_docs.keys())
+    _query_count = len(_qids)
+    _query_to_ref = np.array([_reference["qid_index"][qid] for qid in _qids], dtype=np.int64)
+    _ref_to_query = np.full(len(_reference["qids"]), -1, dtype=np.int64)
+    _ref_to_query[_query_to_ref] = np.arange(_query_count)
+
+    #
+    # 1. model results inside the cutoff, ranked by score (ties in file order)
+    #
+    _lengths = [len(qids_to_ranked_candidate_docs[qid]) for qid in _qids]
+    _run_query = np.repeat(np.arange(_query_count), _lengths)
+    _run_doc_ids = list(itertools.chain.from_iterable(qids_to_ranked_candidate_docs.values()))
+    _run_scores = np.fromiter(itertools.chain.from_iterable(_docs.values() for _docs in 
+                                                            qids_to_ranked_candidate_docs.values()),
+                              dtype=np.float64, count=len(_run_query))
+    _run_ref_rows = np.fromiter(itertools.chain.from_iterable(map(_reference["doc_rows"][_ref_i].get, 
+                                                                  qids_to_ranked_candidate_docs[qid], 
+                                                                  itertools.repeat(-1))
+                                                              for qid, _ref_i in zip(_qids, _query_to_ref)),
+                                dtype=np.int64, count=len(_run_query))
+    _run_doc_ids = np.array(_run_doc_ids, dtype=object)
+    _reranked = (_run_ref_rows >= 0) & (_reference["rank"][_run_ref_rows] <= _cutoff)
+    _reranked_rows = argsort_in_groups(-_run_scores, _run_query)
+    _reranked_rows = _reranked_rows[_reranked[_reranked_rows]]
+    _reranked_count = np.bincount(_run_query[_reranked_rows], minlength=_query_count)
+
+    #
+    # candidate set up to the cutoff, of the candidate queries
+    #
+    _tuple_rows = np.flatnonzero((_reference["position"] < _cutoff) & (_ref_to_query[_reference["query_index"]] >= 0))
+    _tuple_query = _ref_to_query[_reference["query_index"][_tuple_rows]]
+    _tuple_position = _reference["position"][_tuple_rows]
+    _tuple_doc_ids = _reference["doc_id"][_tuple_rows]
+    _tuple_scores = _reference["score"][_tuple_rows]
+
+    _max_reference_score = np.full(_query_count, -np.inf)
+    np.maximum.at(_max_reference_score, _tuple_query, _tuple_scores)
+    _min_reranked_score = np.full(_query_count, np.inf)
+    np.minimum.at(_min_reranked_score, _run_query[_reranked_rows], _run_scores[_reranked_rows])
+    _score_diff = np.where(_reranked_count > 0, _min_reranked_score - _max_reference_score, _max_reference_score)
+
+    #
+    # 2. backfill: the candidates are visited while <reranked + added so far> is below the cutoff
+    #
+    _is_reranked_row = np.zeros(len(_reference["doc_row"]), dtype=bool)
+    _is_reranked_row[_run_ref_rows[_reranked_rows]] = True
+    _in_reranked = _is_reranked_row[_reference["doc_row"][_tuple_rows]]
+    _not_reranked = (~_in_reranked).astype(np.int64)
+    # the tuples of a query are consecutive, in candidate order
+    _added_before = cumsum_in_groups(_not_reranked, _tuple_query) - _not_reranked
+    _visited = _reranked_count[_tuple_query] + _added_before < _cutoff
+    _backfilled = _visited & (_not_reranked > 0)
+    _added_count = _reranked_count + np.bincount(_tuple_query[_backfilled], minlength=_query_count)
     
+    #
+    # 3. the rest, from position <added documents> on
+    #
+    _rest = _tuple_position >= _added_count[_tuple_query]
+
+    #
+    # the assignments of 1., 2. and 3. in order, applied per query as dict(...) (later assignments of the same 
+    # document overwrite the score, but keep its position)
+    #
+    _shifted_scores = _tuple_scores + _score_diff[_tuple_query]
+    _assign_query = np.concatenate([_run_query[_reranked_rows], _tuple_query[_backfilled], _tuple_query[_rest]])
+    _assign_doc_ids = np.concatenate([_run_doc_ids[_reranked_rows], _tuple_doc_ids[_backfilled], 
+                                      _tuple_doc_ids[_rest]])
+    _assign_scores = np.concatenate([_run_scores[_reranked_rows], _shifted_scores[_backfilled], 
+                                     _shifted_scores[_rest]])
+    _assign_order = np.argsort(_assign_query, kind="stable")
+    _assign_bounds = np.searchsorted(_assign_query[_assign_order], np.arange(_query_count + 1))
+    _assign_doc_ids = _assign_doc_ids[_assign_order].tolist()
+    _assign_scores = _assign_scores[_assign_order].tolist()
+
     pruned_qids_to_ranked_candidate_docs = {}
-    for qid in qids_to_ranked_candidate_docs:
-        rank_docids = list(qids_to_ranked_candidate_docs[qid].items())
-        rank_docids.sort(key=lambda x: x[1], reverse=True)
-        rank_docids = [x[0] for x in rank_docids]
-
-        pruned_qids_to_ranked_candidate_docs[qid] = {}
-        added = 0
-        added_docids = []
-        for rank, docid in enumerate(rank_docids):
-            if docid in reference_set_rank[qid] and reference_set_rank[qid][docid] <= reference_set_cutoff:
-                pruned_qids_to_ranked_candidate_docs[qid][docid] = qids_to_ranked_candidate_docs[qid][docid]
-                added_docids.append(docid)
-                added += 1
-
-        _scores = list(pruned_qids_to_ranked_candidate_docs[qid].values())
-        if len(_scores) > 0:
-            score_diff = np.min(_scores) - np.max([x[1] for x in reference_set_tuple[qid]])
-        else:
-            score_diff = np.max([x[1] for x in reference_set_tuple[qid]])
-        # adding what is rest till i to the list if it is missing
-        for _tuple in reference_set_tuple[qid]:
-            docid, score = _tuple
-            if reference_set_cutoff <= added:
-                break
-            if docid not in added_docids:
-                pruned_qids_to_ranked_candidate_docs[qid][docid] = score + score_diff # make scores lower than "pruned"
-                added += 1
-
-        # adding the rest from i or added till the end
-        for j in range(added, len(reference_set_tuple[qid])):
-            docid, score = reference_set_tuple[qid][j]
-            pruned_qids_to_ranked_candidate_docs[qid][docid] = score + score_diff
-
-    candidate_path_for_save_pruned = path_to_candidate+'.pruned'
-    #path_to_candidate_pruned = path_to_candidate+'.pruned'
-    #save_sorted_results(pruned_qids_to_ranked_candidate_docs, path_to_candidate_pruned)
-    metric_results_avg, metric_results_perq = compute_metrics(evaluator, pruned_qids_to_ranked_candidate_docs,
-                                                              candidate_path_for_save_pruned)
+    for _query_i, qid in enumerate(_qids):
+        _start, _end = _assign_bounds[_query_i], _assign_bounds[_query_i + 1]
+        pruned_qids_to_ranked_candidate_docs[qid] = dict(zip(_assign_doc_ids[_start:_end], _assign_scores[_start:_end]))
+
+    # only the trec_eval binary (EvaluationToolTrec) writes the ranking to candidate_path_for_save
+    metric_results_avg, metric_results_perq = {}, {}
+    if evaluator is not None:
+        metric_results_avg, metric_results_perq = compute_metrics(evaluator, pruned_qids_to_ranked_candidate_docs,
+                                                                  candidate_path_for_save)
         
     result_info = {}
     result_info["metrics_avg"] = metric_results_avg
@@ -184,100 +286,240 @@ def save_sorted_results(results, file_path, until_rank=-1):
                 if until_rank > -1 and rank_i == until_rank + 1:
                     break
 
-def save_adv_predictions(adv_predictions_labels, file_path):
+#
+# the run files are only written for archival, nothing reads them back during the evaluation: they are written by a 
+# background thread while the training / evaluation continues. wait_for_saved_results() blocks until all are written
+#
+RUNFILE_WRITER = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+RUNFILE_WRITER_PENDING = []
+
+def save_sorted_results_async(results, file_path, until_rank=-1):
+    RUNFILE_WRITER_PENDING.append(RUNFILE_WRITER.submit(save_sorted_results, results, file_path, until_rank))
+    # collect the finished ones, a failed write raises here
+    while len(RUNFILE_WRITER_PENDING) > 0 and RUNFILE_WRITER_PENDING[0].done():
+        RUNFILE_WRITER_PENDING.pop(0).result()
+
+def wait_for_saved_results():
+    while len(RUNFILE_WRITER_PENDING) > 0:
+        RUNFILE_WRITER_PENDING.pop(0).result()
+
+def save_adv_predictions(scored_tuples, file_path):
     with open(file_path, "w") as fw:
-        for qid in adv_predictions_labels:
-            for docid in adv_predictions_labels[qid]:
-                # qid docid prediction_label
-                vals = adv_predictions_labels[qid][docid]
-                fw.write("%s %s %d\n" % (str(qid), str(docid), vals[0]))
+        # qid docid prediction_label
+        for qid, docid, prediction in zip(scored_tuples["query_id"].tolist(), scored_tuples["doc_id"].tolist(),
+                                          scored_tuples["adv_prediction"].tolist()):
+            fw.write("%s %s %d\n" % (str(qid), str(docid), prediction))
 
 
+class ScoredTuples():
+    """
+    columnar inference results: one row per scored (query, document) tuple, with the relevance score, the 
+    prediction of the adversary and the protected label. the columns are numpy arrays that double their capacity
+    when they are full
+    """
+    COLUMNS = {"query_id": np.int64, "doc_id": object, "score": np.float32, 
+               "adv_prediction": np.int8, "protected_label": np.int8}
+
+    def __init__(self, capacity: int = 65536):
+        self.size = 0
+        self._columns = {_name: np.empty(capacity, dtype=_dtype) for _name, _dtype in self.COLUMNS.items()}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self._columns[column][:self.size]
+
+    def append(self, **columns):
+        _count = len(columns["score"])
+        _capacity = len(self._columns["score"])
+        if self.size + _count > _capacity:
+            _capacity = max(_capacity * 2, self.size + _count)
+            for _name in self._columns:
+                _grown = np.empty(_capacity, dtype=self._columns[_name].dtype)
+                _grown[:self.size] = self._columns[_name][:self.size]
+                self._columns[_name] = _grown
+        for _name, _values in columns.items():
+            self._columns[_name][self.size:self.size + _count] = _values
+        self.size += _count
+
+    # dict[query_id][doc_id] -> score
+    def to_relscores(self) -> Dict[int, Dict[str, float]]:
+        qry_doc_relscores = {}
+        for qid, docid, score in zip(self["query_id"].tolist(), self["doc_id"].tolist(), self["score"].tolist()):
+            if qid not in qry_doc_relscores:
+                qry_doc_relscores[qid] = {}
+            qry_doc_relscores[qid][docid] = score
+        return qry_doc_relscores
+
+    # dict[str query_id][doc_id] -> score, the same ranking as load_candidate() reads from the saved run file (the 
+    # scores are rounded to the score_precision decimals of the run file, the documents are in the order of the run 
+    # file, which decides the ties of the rounded scores)
+    def to_candidate(self, score_precision=6) -> Dict[str, Dict[str, float]]:
+        return columns_to_candidate(self["query_id"], self["doc_id"], self["score"], score_precision)
+
+# the documents of each query are ordered by their unrounded score (descending, stable), as in the saved run file
+def columns_to_candidate(query_ids, doc_ids, scores, score_precision=6) -> Dict[str, Dict[str, float]]:
+    qids_to_ranked_candidate_docs = {}
+    # the rows of a query are consecutive after the stable sort by query (in order of the first appearance)
+    _, _first_rows, _query_index = np.unique(query_ids, return_index=True, return_inverse=True)
+    _first_appearance = np.empty(len(_first_rows), dtype=np.int64)
+    _first_appearance[np.argsort(_first_rows)] = np.arange(len(_first_rows))
+    _query_index = _first_appearance[_query_index]
+    _rows = np.argsort(_query_index, kind="stable")
+    _rows = _rows[argsort_in_groups(-scores[_rows].astype(np.float64), _query_index[_rows])]
+    _scores = np.round(scores[_rows].astype(np.float64), score_precision)
+    for qid, docid, score in zip(query_ids[_rows].tolist(), doc_ids[_rows].tolist(), _scores.tolist()):
+        qid = str(qid)
+        if qid not in qids_to_ranked_candidate_docs:
+            qids_to_ranked_candidate_docs[qid] = {}
+        qids_to_ranked_candidate_docs[qid][str(docid)] = score
+
+    # documents scored more than once per query: the last score counts (as in the dict that was saved)
+    _row_counts = np.bincount(_query_index)
+    _duplicates = [qid for qid, _count in zip(qids_to_ranked_candidate_docs, _row_counts.tolist())
+                   if len(qids_to_ranked_candidate_docs[qid]) != _count]
+    for qid in _duplicates:
+        _query_rows = np.flatnonzero(query_ids.astype(str) == qid)
+        _docs = {}
+        for docid, score in zip(doc_ids[_query_rows].tolist(), scores[_query_rows].astype(np.float64).tolist()):
+            _docs[str(docid)] = score
+        _ranked = sorted(_docs.items(), key=lambda x: x[1], reverse=True)
+        qids_to_ranked_candidate_docs[qid] = {docid: round(score, score_precision) for docid, score in _ranked}
+    return qids_to_ranked_candidate_docs
+
+
+#
+# in-memory cache of the tokenized evaluation batches, keyed by the tsv path and the candidate filter. filled by the 
+# first pass over the files (if the config sets cache_evaluation_batches) and reused by the following validation 
+# rounds and the test
+#
+EVALUATION_BATCH_CACHE = {}
+
+def compact_batch(batch):
+    _compact = {}
+    for _field, _value in batch.items():
+        if not torch.is_tensor(_value):
+            _compact[_field] = list(_value)
+        elif _field.endswith("_tokens"):
+            _dtype = torch.int16 if _value.numel() == 0 or _value.max() < 2**15 else torch.int32
+            _compact[_field] = _value.to(_dtype, copy=True)
+        else:
+            _compact[_field] = _value.clone()
+    return _compact
+
+def queue_batches(queue, producer_count, loader_stats):
+    batch_null_cnt = 0
+    while (True):
+        batch = loader_stats.timed_get(queue)
+        if batch is None:
+            batch_null_cnt += 1
+            if batch_null_cnt == producer_count:
+                break
+            else:
+                continue
+        yield batch
+
 #
-# raw model evaluation, returns model results as python dict, does not save anything / no metrics
+# raw model evaluation, returns the model results as ScoredTuples, does not save anything / no metrics
+# candidate_filter: (candidate set path, cutoff), only the tuples inside the cutoff are tokenized and scored
+# scored_callback(scored_tuples, query_ids of the batch) is called after each batch
 #
-def predict_relevance(model, cuda_device, eval_tsv, config, logger):
+def predict_relevance(model, cuda_device, eval_tsv, config, logger, use_adversary=True, candidate_filter=None,
+                      scored_callback=None):
 
     model.eval()  # turning off training
-    qry_doc_relscores = {}
-    protected_predictions_labels = {}
+    scored_tuples = ScoredTuples()
     _processes = []
+    _queue = None
     
     _max_batch_count = config["max_evaluation_batch_count"]
     _log_interval = config["eval_log_interval"]
+    _cache_batches = config.get("cache_evaluation_batches", False)
+    _new_cached_batches = None
+    # the batches also depend on the batching and tokenization settings of the loaders
+    _cache_key = (eval_tsv, candidate_filter) + tuple(str(config.get(_name)) for _name in 
+                  ["batching", "batch_size_eval", "batch_token_budget_eval", "batch_token_budget_shuffle_window", 
+                   "batch_token_budget_max_batch_size", "max_query_length", "max_doc_length", 
+                   "evaluation_query_partition"])
         
     try:
-        _files = glob.glob(eval_tsv)
-        _queue, _processes, _exit = get_multiprocess_batch_queue("eval-batches",
-                                                                 multiprocess_validation_loader,
-                                                                 files=_files,
-                                                                 conf=config,
-                                                                 _logger=logger,
-                                                                 queue_size=200)
+        if _cache_batches and (_cache_key in EVALUATION_BATCH_CACHE):
+            logger.info("Using %d cached batches of %s" % (len(EVALUATION_BATCH_CACHE[_cache_key]), eval_tsv))
+            _batches = iter(EVALUATION_BATCH_CACHE[_cache_key])
+        else:
+            _files = glob.glob(eval_tsv)
+            _loader_config = dict(config, evaluation_candidate_filter=candidate_filter)
+            _queue, _processes, _exit, _loader_stats = get_multiprocess_batch_queue("eval-batches",
+                                                                                    multiprocess_validation_loader,
+                                                                                    files=_files,
+                                                                                    conf=_loader_config,
+                                                                                    _logger=logger,
+                                                                                    queue_size=200)
+            _batches = queue_batches(_queue, len(_files), _loader_stats)
+            if _cache_batches:
+                _new_cached_batches = []
         batch_num = 0
-        batch_null_cnt = 0
-
-        with torch.no_grad():
-            while (True):
-                batch_orig = _queue.get()
-                if batch_orig is None:
-                    batch_null_cnt += 1
-                    if batch_null_cnt == len(_files):
-                        break
-                    else:
-                        continue
+
+        # inference_mode additionally skips the version counting and view tracking of the autograd
+        _autograd_mode = torch.no_grad() if use_adversary else torch.inference_mode()
+        with _autograd_mode:
+            for batch_orig in _batches:
                 if batch_num >= _max_batch_count and _max_batch_count != -1:
+                    _new_cached_batches = None # only complete passes are cached
                     break
+                if _new_cached_batches is not None:
+                    batch_orig = compact_batch(batch_orig)
+                    _new_cached_batches.append(batch_orig)
 
-                batch = copy.deepcopy(batch_orig)
+                # move_to_device copies to the gpu and leaves batch_orig unchanged, on the cpu the tensors are used as they are
+                batch = batch_orig
                 if cuda_device != -1:
-                    batch = move_to_device(batch, cuda_device)
+                    batch = move_to_device(batch_orig, cuda_device)
                 
-                output_dict = model.forward(batch["query_tokens"], batch["doc_tokens"])
+                output_dict = model.forward(batch["query_tokens"], batch["doc_tokens"], use_adversary=use_adversary)
                 
-                rels = output_dict["rels"]
-                rels = rels.cpu()  # get the relevance scores back to the cpu - in one piece
+                rels = output_dict["rels"].float().cpu().numpy()  # get the relevance scores back to the cpu - in one piece
                 if "adv_logprobs" in output_dict:
-                    adv_logprobs = output_dict["adv_logprobs"]
-                    adv_logprobs = adv_logprobs.cpu()  # get the relevance scores back to the cpu - in one piece
-
-                for sample_i, sample_query_id in enumerate(batch_orig["query_id"]):  # operate on cpu memory
-                    sample_query_id = sample_query_id
-                    sample_doc_id = batch_orig["doc_id"][sample_i]  # again operate on cpu memory
-                    sample_protected_label = batch_orig["protected_label"][sample_i]  # again operate on cpu memory
-
-                    if sample_query_id not in qry_doc_relscores:
-                        qry_doc_relscores[sample_query_id] = {}
-                        protected_predictions_labels[sample_query_id] = {}
-
-                    qry_doc_relscores[sample_query_id][sample_doc_id] = float(rels[sample_i])
-                    
-                    if "adv_logprobs" in output_dict:
-                        _predicted_protected_label = int(torch.argmax(adv_logprobs[sample_i]))
-                    else:
-                        _predicted_protected_label = 0
-                    protected_predictions_labels[sample_query_id][sample_doc_id] = (_predicted_protected_label,
-                                                                                    sample_protected_label)
-                    
+                    _predicted_protected_labels = output_dict["adv_logprobs"].argmax(dim=-1).cpu().numpy()
+                else:
+                    _predicted_protected_labels = 0
+
+                scored_tuples.append(query_id=batch_orig["query_id"], doc_id=batch_orig["doc_id"], score=rels,
+                                     adv_prediction=_predicted_protected_labels, 
+                                     protected_label=batch_orig["protected_label"].numpy())
+                if scored_callback is not None:
+                    scored_callback(scored_tuples, batch_orig["query_id"])
                 
                 if batch_num % _log_interval == 0:
                     logger.info('INFERENCE | %5d batches' % (batch_num))
-                    if _queue.qsize() < 10:
+                    if (_queue is not None) and (_queue.qsize() < 10):
                         logger.warning("evaluation_queue.qsize() < 10 (%d)" % _queue.qsize())
 
                 batch_num += 1
 
         logger.info('INFERENCE FINISHED | %5d batches ' % (batch_num))
         
-        # make sure we didn't make a mistake in the configuration / data preparation
-        if _queue.qsize() != 0 and _max_batch_count == -1:
-            logger.error("evaluation_queue.qsize() is not empty (%d) after evaluation" % _queue.qsize())
+        if _queue is not None:
+            # make sure we didn't make a mistake in the configuration / data preparation
+            if _queue.qsize() != 0 and _max_batch_count == -1:
+                logger.error("evaluation_queue.qsize() is not empty (%d) after evaluation" % _queue.qsize())
 
-        _exit.set()  # allow sub-processes to exit
+            _loader_stats_summary = _loader_stats.summary()
+            logger.info('INFERENCE | loader %.1f lines/s | waiting on the queue %.2f%% of the time' % 
+                        (_loader_stats_summary["lines_per_sec"], _loader_stats_summary["consumer_wait_fraction"] * 100))
+            if config.get("tokenization_cache_size", 0) > 0:
+                logger.info('INFERENCE | tokenization cache hit-rate: query %.4f doc %.4f' % 
+                            (_loader_stats_summary["query_cache_hit_rate"], _loader_stats_summary["doc_cache_hit_rate"]))
 
-        for proc in _processes:
-            if proc.is_alive():
-                proc.terminate()
+            _exit.set()  # allow sub-processes to exit
+
+            for proc in _processes:
+                if proc.is_alive():
+                    proc.terminate()
+
+        if _new_cached_batches is not None:
+            EVALUATION_BATCH_CACHE[_cache_key] = _new_cached_batches
 
     except BaseException as e:
         logger.exception('[eval_model] Got exception: %s' % str(e))
@@ -287,7 +529,274 @@ def predict_relevance(model, cuda_device, eval_tsv, config, logger):
                 proc.terminate()
         raise e
 
-    return qry_doc_relscores, protected_predictions_labels
+    return scored_tuples
+
+#
+# query-parallel inference on the cpu: the queries are split across worker_count processes (query_id % worker_count), 
+# each with its own copy of the model and threads_per_worker intra-op threads, and with its own loader processes 
+# and evaluation batch cache. the workers are started once and kept for the following evaluations
+#
+QUERY_PARALLEL_INFERENCE = {}
+
+def get_query_parallel_inference(config):
+    _worker_count = int(config["inference_query_parallel_workers"])
+    _threads_per_worker = int(config.get("inference_threads_per_worker", -1))
+    if _threads_per_worker == -1:
+        _threads_per_worker = max(1, os.cpu_count() // _worker_count)
+    if (_worker_count, _threads_per_worker) not in QUERY_PARALLEL_INFERENCE:
+        QUERY_PARALLEL_INFERENCE[(_worker_count, _threads_per_worker)] = QueryParallelInference(_worker_count, 
+                                                                                                _threads_per_worker)
+    return QUERY_PARALLEL_INFERENCE[(_worker_count, _threads_per_worker)]
+
+# stops the workers, also called at exit (before multiprocessing joins the non-daemon processes)
+def close_query_parallel_inference():
+    for _inference in QUERY_PARALLEL_INFERENCE.values():
+        _inference.close()
+    QUERY_PARALLEL_INFERENCE.clear()
+
+atexit.register(close_query_parallel_inference)
+
+#
+# inference worker: re-creates the model from its arguments once, loads the weights of every job and scores its 
+# part of the queries, the columns of the ScoredTuples are sent back (None signals a failure)
+#
+def query_parallel_inference_process(worker_index, worker_count, threads, jobs_queue, results_queue):
+    torch.set_num_threads(threads)
+    logger = get_logger_to_console("inference-worker-%d" % worker_index)
+    model = None
+    while True:
+        _job = jobs_queue.get()
+        if _job is None:
+            break
+        try:
+            model_args, model_state, eval_tsv, config, cpu_optimized, candidate_filter = _job
+            if model is None:
+                model = create_model_from_args(model_args)
+            model.load_state_dict(model_state)
+            del model_state, _job  # releases the shared memory of the weights
+
+            _config = dict(config, evaluation_query_partition=(worker_index, worker_count))
+            if cpu_optimized:
+                _inference_model = get_cpu_inference_model(model, 
+                                                           quantize_int8=config.get("inference_quantize_int8", False))
+                scored_tuples = predict_relevance(_inference_model, -1, eval_tsv, _config, logger, use_adversary=False,
+                                                  candidate_filter=candidate_filter)
+            else:
+                scored_tuples = predict_relevance(model, -1, eval_tsv, _config, logger, 
+                                                  candidate_filter=candidate_filter)
+            results_queue.put((worker_index, {_name: scored_tuples[_name] for _name in ScoredTuples.COLUMNS}))
+        except BaseException as e:
+            logger.exception('[query_parallel_inference] Got exception: %s' % str(e))
+            results_queue.put((worker_index, None))
+
+class QueryParallelInference():
+    def __init__(self, worker_count: int, threads_per_worker: int):
+        self.worker_count = worker_count
+        self.threads_per_worker = threads_per_worker
+
+        _context = mp.get_context("spawn")
+        self._jobs_queues = [_context.Queue() for _ in range(worker_count)]
+        self._results_queue = _context.Queue()
+        # not daemons: the workers start their own loader processes
+        self._processes = [_context.Process(name="inference-worker-%d" % _worker_index,
+                                            target=query_parallel_inference_process,
+                                            args=(_worker_index, worker_count, threads_per_worker,
+                                                  self._jobs_queues[_worker_index], self._results_queue))
+                           for _worker_index in range(worker_count)]
+        for _process in self._processes:
+            _process.start()
+
+    def predict(self, model, eval_tsv, config, logger, cpu_optimized=False, candidate_filter=None) -> ScoredTuples:
+        logger.info("Query-parallel inference with %d workers, %d threads each" % (self.worker_count, 
+                                                                                   self.threads_per_worker))
+        # one cpu copy of the weights, shared by all workers
+        _model_state = {_name: _tensor.detach().to("cpu", copy=True) for _name, _tensor in model.state_dict().items()}
+        for _jobs_queue in self._jobs_queues:
+            _jobs_queue.put((get_model_args(model), _model_state, eval_tsv, config, cpu_optimized, candidate_filter))
+        del _model_state
+
+        _results = [None] * self.worker_count
+        for _ in range(self.worker_count):
+            _worker_index, _columns = self._wait_for_result()
+            if _columns is None:
+                raise Exception("Query-parallel inference failed in worker %d" % _worker_index)
+            _results[_worker_index] = _columns
+
+        scored_tuples = ScoredTuples(capacity=max(1, sum(len(_columns["score"]) for _columns in _results)))
+        for _columns in _results:
+            scored_tuples.append(**_columns)
+        logger.info("Query-parallel inference finished, %d tuples scored" % len(scored_tuples))
+        return scored_tuples
+
+    def close(self):
+        for _jobs_queue, _process in zip(self._jobs_queues, self._processes):
+            if _process.is_alive():
+                _jobs_queue.put(None)
+        for _process in self._processes:
+            _process.join()
+
+    def _wait_for_result(self):
+        while True:
+            try:
+                return self._results_queue.get(timeout=10)
+            except queue.Empty:
+                for _worker_index, _process in enumerate(self._processes):
+                    if not _process.is_alive():
+                        raise Exception("Query-parallel inference worker %d exited with code %s" % 
+                                        (_worker_index, str(_process.exitcode)))
+
+#
+# FaiRR / NFaiRR of a ranking (dict[qid][docid] -> score, or the path of its run file), added to the metrics of 
+# result_info as <metric>_<rank cutoff>
+#
+def add_fairness_metrics(result_info, evaluator_fairness, qry_doc_relscores):
+    _metrichelper = FaiRRMetricHelper()
+    if isinstance(qry_doc_relscores, str):
+        _fairness_retrivalresults = _metrichelper.read_retrievalresults_from_runfile(qry_doc_relscores)
+    else:
+        _fairness_retrivalresults = _metrichelper.read_retrievalresults_from_relscores(qry_doc_relscores)
+    _fairness_metric_results = evaluator_fairness.calc_FaiRR_retrievalresults(_fairness_retrivalresults)
+    
+    _fairness_metrics = list(_fairness_metric_results['metrics_avg'].keys())
+    _fairness_metrics.sort()
+    for _m in _fairness_metrics:
+        _cutoffs = list(_fairness_metric_results['metrics_avg'][_m].keys())
+        _cutoffs.sort()
+        for _cutoff in _cutoffs:
+            result_info["metrics_perq"]["%s_%d" % (_m, _cutoff)] = _fairness_metric_results['metrics_perq'][_m][_cutoff]
+            result_info["metrics_avg"]["%s_%d" % (_m, _cutoff)] = _fairness_metric_results['metrics_avg'][_m][_cutoff]
+
+#
+# number of candidates per query (distinct documents up to the cutoff, None for all) in the candidate set file
+#
+CANDIDATE_COUNTS_CACHE = {}
+
+def get_candidate_counts(candidate_set_path, cutoff=None) -> Dict[int, int]:
+    if (candidate_set_path, cutoff) not in CANDIDATE_COUNTS_CACHE:
+        _docs = {}
+        with open(candidate_set_path, "r") as cs_file:
+            for line in cs_file:
+                vals = line.rstrip().split(' ') # 8 Q0 8383396 1 16.144300 Anserini
+                if cutoff is None or int(vals[3]) <= cutoff:
+                    _docs.setdefault(int(vals[0]), set()).add(vals[2])
+        CANDIDATE_COUNTS_CACHE[(candidate_set_path, cutoff)] = {_qid: len(_d) for _qid, _d in _docs.items()}
+    return CANDIDATE_COUNTS_CACHE[(candidate_set_path, cutoff)]
+
+
+class PipelinedMetrics():
+    """
+    computes the metrics of the queries whose candidates are all scored in a background thread, while the inference 
+    continues: add() counts the scored tuples per query against the expected counts (of the candidate set) and 
+    hands the completed queries in chunks of chunk_size queries to the thread, which computes the cutoff merge, the
+    effectiveness metrics and FaiRR of every cutoff. finish() evaluates the rest of the queries (also the ones that 
+    received more tuples after their chunk) and aggregates the per-query results
+    """
+    def __init__(self, evaluator, evaluator_fairness, reference_set_rank, reference_set_tuple, cutoffs,
+                 expected_counts: Dict[int, int], chunk_size: int = 256, candidate_path_for_save=None):
+        self.evaluator = evaluator
+        self.evaluator_fairness = evaluator_fairness
+        self.reference_set_rank = reference_set_rank
+        self.reference_set_tuple = reference_set_tuple
+        self.cutoffs = cutoffs
+        self.expected_counts = expected_counts
+        self.chunk_size = chunk_size
+        self.candidate_path_for_save = candidate_path_for_save
+
+        self._scored_counts = {} # qid -> scored tuples
+        self._submitted_counts = {} # qid -> scored tuples when the query was handed to the thread
+        self._completed = []
+        self._chunks = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def add(self, scored_tuples, query_ids):
+        _qids, _counts = np.unique(np.asarray(query_ids, dtype=np.int64), return_counts=True)
+        for qid, count in zip(_qids.tolist(), _counts.tolist()):
+            self._scored_counts[qid] = self._scored_counts.get(qid, 0) + count
+            if self._scored_counts[qid] == self.expected_counts.get(qid, -1):
+                self._completed.append(qid)
+        if len(self._completed) >= self.chunk_size:
+            self._submit(scored_tuples, self._completed)
+            self._completed = []
+
+    # returns the full ranking and per cutoff: the result_info and the final ranking, the same as computed at once
+    def finish(self, scored_tuples) -> Tuple[Dict[str, Dict[str, float]], Dict[int, Tuple[Dict, Dict]]]:
+        _qids, _counts = np.unique(scored_tuples["query_id"], return_counts=True)
+        _rest = [qid for qid, count in zip(_qids.tolist(), _counts.tolist()) if self._submitted_counts.get(qid) != count]
+        if len(_rest) > 0:
+            self._submit(scored_tuples, _rest)
+        
+        qry_doc_relscores = {}
+        _results_cutoffs = {_cutoff: ({"metrics_avg": {}, "metrics_perq": {}, "cs@n": _cutoff}, {}) 
+                            for _cutoff in self.cutoffs}
+        # later chunks overwrite the results of the queries that were evaluated again
+        _chunks = [_chunk.result() for _chunk in self._chunks]
+        # the metrics in their order of a chunk with effectiveness metrics, the same as computed at once
+        for _chunk_judged_qids, _, _chunk_results in sorted(_chunks, key=lambda _chunk: len(_chunk[0]) == 0):
+            for _cutoff, (_chunk_result_info, _) in _chunk_results.items():
+                for _m in _chunk_result_info["metrics_avg"]:
+                    _results_cutoffs[_cutoff][0]["metrics_avg"].setdefault(_m, None)
+
+        _judged_qids = set()
+        for _chunk_judged_qids, _qry_doc_relscores, _chunk_results in _chunks:
+            _judged_qids.update(_chunk_judged_qids)
+            qry_doc_relscores.update(_qry_doc_relscores)
+            for _cutoff, (_chunk_result_info, _qry_doc_relscores_final) in _chunk_results.items():
+                _result_info, _ranking = _results_cutoffs[_cutoff]
+                _ranking.update(_qry_doc_relscores_final)
+                for _m, _perq in _chunk_result_info["metrics_perq"].items():
+                    _result_info["metrics_perq"].setdefault(_m, {}).update(_perq)
+        self._executor.shutdown()
+        if self.evaluator is not None and len(_judged_qids) == 0:
+            raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
+
+        # averages over the latest results of the queries, the metrics without per-query results (of the trec_eval 
+        # binary) are computed once on the merged ranking of the cutoff
+        for _cutoff, (_result_info, _ranking) in _results_cutoffs.items():
+            _merged_result_info = None
+            for _m in _result_info["metrics_avg"]:
+                if _m in _result_info["metrics_perq"]:
+                    _result_info["metrics_avg"][_m] = float(np.mean(list(_result_info["metrics_perq"][_m].values())))
+                else:
+                    if _merged_result_info is None:
+                        _merged_result_info = self._evaluate_merged(_ranking, len(_judged_qids) > 0)
+                    _result_info["metrics_avg"][_m] = _merged_result_info["metrics_avg"][_m]
+        return qry_doc_relscores, _results_cutoffs
+
+    def _evaluate_merged(self, ranking, judged):
+        _result_info = {"metrics_avg": {}, "metrics_perq": {}}
+        if self.evaluator is not None and judged:
+            _result_info["metrics_avg"], _ = compute_metrics(self.evaluator, ranking, self.candidate_path_for_save)
+        add_fairness_metrics(_result_info, self.evaluator_fairness, ranking)
+        return _result_info
+
+    def _submit(self, scored_tuples, qids):
+        for qid in qids:
+            self._submitted_counts[qid] = self._scored_counts.get(qid)
+        # views of the rows scored so far, the following appends do not change them
+        _columns = {_name: scored_tuples[_name] for _name in ["query_id", "doc_id", "score"]}
+        self._chunks.append(self._executor.submit(self._evaluate_chunk, _columns, np.array(qids, dtype=np.int64)))
+
+    def _evaluate_chunk(self, columns, qids):
+        _rows = np.flatnonzero(np.isin(columns["query_id"], qids))
+        qry_doc_relscores = columns_to_candidate(columns["query_id"][_rows], columns["doc_id"][_rows], 
+                                                 columns["score"][_rows])
+        # the effectiveness metrics are skipped if none of the queries of the chunk has qrels
+        _judged_qids = []
+        if self.evaluator is not None:
+            _qids_with_qrels = self.evaluator.get_qids_with_qrels()
+            _judged_qids = [qid for qid in qry_doc_relscores if _qids_with_qrels is None or qid in _qids_with_qrels]
+        _evaluator = self.evaluator if len(_judged_qids) > 0 else None
+        _chunk_results = {}
+        for _cutoff in self.cutoffs:
+            _result_info, _qry_doc_relscores_final = compute_metrics_at_cutoff(_evaluator, qry_doc_relscores,
+                                                                               self.reference_set_rank, 
+                                                                               self.reference_set_tuple,
+                                                                               reference_set_cutoff=_cutoff,
+                                                                               candidate_path_for_save=
+                                                                               self.candidate_path_for_save)
+            add_fairness_metrics(_result_info, self.evaluator_fairness, _qry_doc_relscores_final)
+            _chunk_results[_cutoff] = (_result_info, _qry_doc_relscores_final)
+        return _judged_qids, qry_doc_relscores, _chunk_results
 
 #
 # evaluate a model + save results and metrics 
@@ -297,64 +806,148 @@ def evaluate_model(model, config, logger, run_folder, cuda_device, evaluator, ev
 
     logger.info("[INFERENCE] --- Start")
 
-    qry_doc_relscores, protected_predictions_labels = predict_relevance(model, cuda_device, config["%s_tsv" % testval], 
-                                                                        config, logger)
+    # the documents are scored once up to the largest cutoff, the metrics are computed for every cutoff
+    _cutoffs = get_reranking_cutoffs(config)
+    _max_cutoff = max(_cutoffs)
+
+    # the documents below the re-ranking cutoff are backfilled from the candidate set by compute_metrics_at_cutoff, 
+    # so skipping them keeps the ranking metrics (opt-in: the adversary accuracy and the full re-ranking file change)
+    _candidate_filter = None
+    if config.get("evaluation_score_only_reranked", False):
+        _candidate_filter = (config["%s_candidate_set_path" % testval], _max_cutoff)
+
+    _fullrerank_runfile_path = os.path.join(run_folder, output_relative_dir, 
+                                            "%s%s-run-full-rerank.txt" % (output_files_prefix, testval))
+
+    # the metrics of the queries are computed as soon as all their candidates (up to the cutoff, if filtered) are 
+    # scored, while the inference continues
+    pipelined_metrics = None
+    _scored_callback = None
+    if config.get("evaluation_pipelined_metrics", False):
+        if _candidate_filter is not None:
+            _expected_counts = {int(qid): len(_docids) for qid, _docids in reference_set_rank.items()}
+        else:
+            _expected_counts = get_candidate_counts(config["%s_candidate_set_path" % testval])
+        pipelined_metrics = PipelinedMetrics(evaluator, evaluator_fairness, reference_set_rank, reference_set_tuple,
+                                             _cutoffs, _expected_counts, 
+                                             chunk_size=config.get("evaluation_pipelined_metrics_chunk_size", 256),
+                                             candidate_path_for_save=_fullrerank_runfile_path + '.pruned')
+        _scored_callback = pipelined_metrics.add
+
+    # cpu-optimized inference: no adversary head, inference_mode autograd and optionally int8 BERT linear layers
+    _cpu_optimized = config.get("inference_mode", "default") == "cpu_optimized"
+    # query-parallel inference in several processes, if the inference runs on the cpu
+    _query_parallel = (config.get("inference_query_parallel_workers", 1) > 1 and 
+                       (_cpu_optimized or cuda_device == -1))
+    if _query_parallel:
+        scored_tuples = get_query_parallel_inference(config).predict(model, config["%s_tsv" % testval], config, logger,
+                                                                     cpu_optimized=_cpu_optimized,
+                                                                     candidate_filter=_candidate_filter)
+    elif _cpu_optimized:
+        _inference_model = get_cpu_inference_model(model, quantize_int8=config.get("inference_quantize_int8", False))
+        scored_tuples = predict_relevance(_inference_model, -1, config["%s_tsv" % testval], config, logger, 
+                                          use_adversary=False, candidate_filter=_candidate_filter,
+                                          scored_callback=_scored_callback)
+    else:
+        scored_tuples = predict_relevance(model, cuda_device, config["%s_tsv" % testval], config, logger,
+                                          candidate_filter=_candidate_filter, scored_callback=_scored_callback)
+    # the ranking stays in memory for the metrics, the run files are written in the background
+    if pipelined_metrics is not None:
+        qry_doc_relscores, _pipelined_results = pipelined_metrics.finish(scored_tuples)
+    else:
+        qry_doc_relscores = scored_tuples.to_candidate()
 
     #
     # save full rerank results
     #
     logger.info("Saving file with prefix: " + output_files_prefix)
-    _fullrerank_runfile_path = os.path.join(run_folder, output_relative_dir, 
-                                            "%s%s-run-full-rerank.txt" % (output_files_prefix, testval))
-    save_sorted_results(qry_doc_relscores, _fullrerank_runfile_path)
+    save_sorted_results_async(qry_doc_relscores, _fullrerank_runfile_path)
 
     #
-    # compute evaluation metrics 
+    # compute evaluation and fairness metrics at each cutoff, result_info holds the ones of the main (first) cutoff 
+    # and result_info["cutoffs"] the ones of all cutoffs
     # ---------------------------------
     #
-    _cutoff = config["evaluation_reranking_cutoff"]
-    result_info, qry_doc_relscores_final = compute_metrics_at_cutoff(evaluator, _fullrerank_runfile_path, 
-                                                                     reference_set_rank, reference_set_tuple,
-                                                                     reference_set_cutoff=config["evaluation_reranking_cutoff"])
-    
-    # save evaluated rank list
-    _final_runfile_path = os.path.join(run_folder, output_relative_dir, "%s%s-run.txt" % (output_files_prefix, testval)) 
-    save_sorted_results(qry_doc_relscores_final, _final_runfile_path)
+    result_info = None
+    _result_info_cutoffs = {}
+    for _cutoff in _cutoffs:
+        # the candidate set is used up to the cutoff, the same as if it was parsed up to this cutoff
+        if pipelined_metrics is not None:
+            _result_info, _qry_doc_relscores_final = _pipelined_results[_cutoff]
+        else:
+            _result_info, _qry_doc_relscores_final = compute_metrics_at_cutoff(evaluator, qry_doc_relscores, 
+                                                                               reference_set_rank, reference_set_tuple,
+                                                                               reference_set_cutoff=_cutoff,
+                                                                               candidate_path_for_save=
+                                                                               _fullrerank_runfile_path + '.pruned')
+            add_fairness_metrics(_result_info, evaluator_fairness, _qry_doc_relscores_final)
+        
+        # save evaluated rank list
+        if result_info is None:
+            _runfile_path = os.path.join(run_folder, output_relative_dir, "%s%s-run.txt" % (output_files_prefix, testval)) 
+        else:
+            _runfile_path = os.path.join(run_folder, output_relative_dir, 
+                                         "%s%s-run-cs%d.txt" % (output_files_prefix, testval, _cutoff)) 
+        save_sorted_results_async(_qry_doc_relscores_final, _runfile_path)
+
+        _result_info_cutoffs[_cutoff] = {"metrics_avg": _result_info["metrics_avg"], 
+                                         "metrics_perq": _result_info["metrics_perq"]}
+        if result_info is None:
+            result_info = _result_info
+            qry_doc_relscores_final = _qry_doc_relscores_final
 
     #
-    # save & evaluate the results of the fairness metric
+    # deviation of the cpu-optimized model from the full precision model
     #
+    if _cpu_optimized and config.get("inference_compare_fp32", False):
+        logger.info("[INFERENCE] --- Start (fp32 reference)")
+        if _query_parallel and cuda_device == -1:
+            qry_doc_relscores_fp32 = get_query_parallel_inference(config).predict(model, config["%s_tsv" % testval], 
+                                                                                  config, logger,
+                                                                                  candidate_filter=_candidate_filter)
+        else:
+            qry_doc_relscores_fp32 = predict_relevance(model, cuda_device, config["%s_tsv" % testval], config, logger,
+                                                       candidate_filter=_candidate_filter)
+        qry_doc_relscores_fp32 = qry_doc_relscores_fp32.to_candidate()
+        _fullrerank_runfile_path_fp32 = os.path.join(run_folder, output_relative_dir, 
+                                                     "%s%s-run-full-rerank-fp32.txt" % (output_files_prefix, testval))
+        save_sorted_results_async(qry_doc_relscores_fp32, _fullrerank_runfile_path_fp32)
+        result_info_fp32, _ = compute_metrics_at_cutoff(evaluator, qry_doc_relscores_fp32, 
+                                                        reference_set_rank, reference_set_tuple,
+                                                        reference_set_cutoff=_cutoffs[0],
+                                                        candidate_path_for_save=
+                                                        _fullrerank_runfile_path_fp32 + '.pruned')
+
+        _deviations = np.abs([qry_doc_relscores[qid][docid] - qry_doc_relscores_fp32[qid][docid]
+                              for qid in qry_doc_relscores for docid in qry_doc_relscores[qid]
+                              if docid in qry_doc_relscores_fp32.get(qid, {})])
+        # e.g. none with a max_evaluation_batch_count truncation
+        if len(_deviations) > 0:
+            result_info["metrics_avg"]["inference_score_deviation_mean"] = np.mean(_deviations)
+            result_info["metrics_avg"]["inference_score_deviation_max"] = np.max(_deviations)
+        else:
+            logger.warning("No tuples scored by both the cpu-optimized and the fp32 model, score deviation skipped")
+        for _m in ["recip_rank", config["metric_tocompare"]]:
+            if _m in result_info_fp32["metrics_avg"]:
+                result_info["metrics_avg"]["inference_%s_delta" % _m] = (result_info["metrics_avg"][_m] - 
+                                                                         result_info_fp32["metrics_avg"][_m])
+        logger.info("Deviation from fp32: %s" % {_m: result_info["metrics_avg"][_m] 
+                                                 for _m in result_info["metrics_avg"] if _m.startswith("inference_")})
+
+    #
+    # accuracy of prediction in the adversary head (skipped in cpu-optimized inference)
+    #
+    if not _cpu_optimized:
+        _accuracy = accuracy_score(scored_tuples["adv_prediction"], scored_tuples["protected_label"])
+        _accuracy_dummybaseline = 1 - (np.sum(scored_tuples["protected_label"]) / float(len(scored_tuples)))
+        
+        result_info["metrics_avg"]["adv_accuracy"] = _accuracy
+        result_info["metrics_avg"]["adv_accuracy_dummybaseline"] = _accuracy_dummybaseline
+        
+        _path = os.path.join(run_folder, output_files_prefix + "adversarial-predictions.txt")
+        save_adv_predictions(scored_tuples, _path)
     
-    # accuracy of prediction in the adversary head
-    _adv_predictions = []
-    _adv_labels = []
-    for qid in protected_predictions_labels:
-        for docid in protected_predictions_labels[qid]:
-            _adv_predictions.append(protected_predictions_labels[qid][docid][0])
-            _adv_labels.append(protected_predictions_labels[qid][docid][1])
-            
-    _accuracy = accuracy_score(_adv_predictions, _adv_labels)
-    _accuracy_dummybaseline = 1 - (np.sum(_adv_labels) / float(len(_adv_labels)))
-    
-    result_info["metrics_avg"]["adv_accuracy"] = _accuracy
-    result_info["metrics_avg"]["adv_accuracy_dummybaseline"] = _accuracy_dummybaseline
-    
-    _path = os.path.join(run_folder, output_files_prefix + "adversarial-predictions.txt")
-    save_adv_predictions(protected_predictions_labels, _path)
-    
-    # fairness metrics
-    _metrichelper = FaiRRMetricHelper()
-    _fairness_retrivalresults = _metrichelper.read_retrievalresults_from_runfile(_final_runfile_path)
-    _fairness_metric_results = evaluator_fairness.calc_FaiRR_retrievalresults(_fairness_retrivalresults)
-    
-    _fairness_metrics = list(_fairness_metric_results['metrics_avg'].keys())
-    _fairness_metrics.sort()
-    for _m in _fairness_metrics:
-        _cutoffs = list(_fairness_metric_results['metrics_avg'][_m].keys())
-        _cutoffs.sort()
-        for _cutoff in _cutoffs:
-            result_info["metrics_perq"]["%s_%d" % (_m, _cutoff)] = _fairness_metric_results['metrics_perq'][_m][_cutoff]
-            result_info["metrics_avg"]["%s_%d" % (_m, _cutoff)] = _fairness_metric_results['metrics_avg'][_m][_cutoff]
+    result_info["cutoffs"] = _result_info_cutoffs
     
     # save final results
     logger.info("Results: %s" % (result_info["metrics_avg"]))
@@ -362,9 +955,68 @@ def evaluate_model(model, config, logger, run_folder, cuda_device, evaluator, ev
     _path = os.path.join(run_folder, output_relative_dir, "%s%s-metrics.txt" % (output_files_prefix, testval)) 
     with open(_path, "w") as fw:
         fw.write(str(result_info["metrics_avg"]))
+    if len(_cutoffs) > 1:
+        _path = os.path.join(run_folder, output_relative_dir, "%s%s-metrics-cutoffs.txt" % (output_files_prefix, testval)) 
+        with open(_path, "w") as fw:
+            for _cutoff in _cutoffs:
+                fw.write("%d\t%s\n" % (_cutoff, str(_result_info_cutoffs[_cutoff]["metrics_avg"])))
     _path = os.path.join(run_folder, output_relative_dir, "%s%s-metrics.pkl" % (output_files_prefix, testval)) 
     
     with open(_path, "wb") as fw:
         pickle.dump(result_info, fw)
     
     return result_info, qry_doc_relscores_final
+
+#
+# validation during training: evaluates the model (of epoch / batch_cnt_global), logs the metrics to tensorboard and 
+# stores the model and its results if they are the best so far (or always, if always_store_best). 
+# validation_set: the evaluator, evaluator_fairness, reference_set_rank and reference_set_tuple of the validation
+# returns the results and the best results so far
+#
+def validate_and_store_best(model, config, logger, run_folder, cuda_device, validation_set, tb_writer, 
+                            best_result_info, epoch, batch_cnt_global, always_store_best=False):
+
+    _output_relative_dir = os.path.join(run_folder, "checkpoints/chk%d-%d/" % (epoch, batch_cnt_global))
+    if not os.path.exists(_output_relative_dir):
+        os.makedirs(_output_relative_dir)
+    
+    _result_info, _qry_doc_relscores = evaluate_model(model, config, logger, run_folder, cuda_device,
+                                                      evaluator=validation_set["evaluator"],
+                                                      evaluator_fairness=validation_set["evaluator_fairness"],
+                                                      reference_set_rank=validation_set["reference_set_rank"], 
+                                                      reference_set_tuple=validation_set["reference_set_tuple"],
+                                                      output_files_prefix="",
+                                                      output_relative_dir=_output_relative_dir,
+                                                      testval="validation")
+    
+    for _m in _result_info["metrics_avg"]:
+        tb_writer.add_scalar("val/%s" % _m, _result_info["metrics_avg"][_m], batch_cnt_global)
+
+    _metric = config["metric_tocompare"]
+    if (always_store_best or (best_result_info is None) or 
+        (_result_info["metrics_avg"][_metric] > best_result_info["metrics_avg"][_metric])):
+        
+        best_result_info = _result_info
+        
+        # save validation results
+        _best_result_output_path = os.path.join(run_folder, "validation-best-run.txt")
+        _best_result_info_path = os.path.join(run_folder, "validation-best-metrics.txt")
+        _best_result_info_pkl_path = os.path.join(run_folder, "validation-best-metrics.pkl")
+        _best_model_store_path = os.path.join(run_folder, "model.best.pt")
+        
+        save_sorted_results_async(_qry_doc_relscores, _best_result_output_path)
+
+        with open(_best_result_info_path, "w") as fw:
+            fw.write("{'metrics_avg':%s, 'epoch':%d, 'batch_number':%d}" % 
+                     (str(best_result_info["metrics_avg"]), epoch, batch_cnt_global))
+        
+        with open(_best_result_info_pkl_path, "wb") as fw:
+            pickle.dump(best_result_info, fw)
+        
+        # save (best) validation model state
+        logger.info("Saving new model with %s of %.4f at %s" % (_metric, 
+                                                                best_result_info['metrics_avg'][_metric],
+                                                                _best_model_store_path))
+        model_save(_best_model_store_path, model, best_result_info)
+
+    return _result_info, best_result_info
@@ -0,0 +1,112 @@
+#
+# export the ranker of a trained AdvBert for serving
+# -------------------------------
+#
+# exports the relevance scoring path (BERT + output projection, without the adversary and the gradient reversal)
+# of <run-folder>/model.best.pt to TorchScript or ONNX, with dynamic batch and sequence axes, and validates the
+# exported graph (through RankerRuntime) against the rels of the PyTorch model on a sample batch
+#
+# usage:
+# python export_ranker.py --run-folder [PATH] --format onnx
+
+import argparse
+import os
+import sys
+sys.path.append(os.getcwd())
+
+import numpy as np
+import torch
+
+from transformers import BertTokenizer
+
+from model import AdvBert, AdvBertRankerGraph, get_bert_model
+from bert_input import prepare_bert_input
+from ranker_runtime import RankerRuntime
+from utils import load_config, model_load
+
+
+def get_sample_batch(batch_size, vocab_size, max_query_length=20, max_doc_length=250, seed=1111):
+    _random = np.random.RandomState(seed)
+    query = np.zeros((batch_size, max_query_length), dtype=np.int64)
+    document = np.zeros((batch_size, max_doc_length), dtype=np.int64)
+    for _i in range(batch_size):
+        _query_length = _random.randint(1, max_query_length + 1)
+        _doc_length = _random.randint(1, max_doc_length + 1)
+        query[_i, :_query_length] = _random.randint(1000, vocab_size, _query_length)
+        document[_i, :_doc_length] = _random.randint(1000, vocab_size, _doc_length)
+    return torch.from_numpy(query), torch.from_numpy(document)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--run-folder', action='store', dest='run_folder',
+                        help='run folder containing config.yaml and model.best.pt', required=True)
+    parser.add_argument('--format', action='store', choices=['torchscript', 'onnx'], default='onnx',
+                        help='format of the exported graph')
+    parser.add_argument('--out-file', action='store', dest='out_file',
+                        help='path of the exported graph, default: <run-folder>/ranker.pt (.onnx)', required=False)
+    parser.add_argument('--onnx-opset', action='store', dest='onnx_opset', type=int, default=14,
+                        help='ONNX opset version')
+    parser.add_argument('--tolerance', action='store', type=float, default=1e-4,
+                        help='maximum absolute difference of the exported rels to the PyTorch model')
+    args = parser.parse_args()
+
+    config = load_config(os.path.join(args.run_folder, "config.yaml"))
+    if args.out_file is None:
+        args.out_file = os.path.join(args.run_folder, "ranker.pt" if args.format == 'torchscript' else "ranker.onnx")
+
+    #
+    # model
+    #
+    _bert_tokenizer = BertTokenizer.from_pretrained(config["transformers_tokenizer_model_id"])
+    _bert_cls_token_id = _bert_tokenizer.vocab[_bert_tokenizer.cls_token]
+    _bert_sep_token_id = _bert_tokenizer.vocab[_bert_tokenizer.sep_token]
+
+    model = AdvBert(bert=get_bert_model(config), adv_rev_factor=config["adv_rev_factor"],
+                    cls_token_id=_bert_cls_token_id, sep_token_id=_bert_sep_token_id,
+                    dynamic_input_length=True, input_length_multiple=config.get("input_length_multiple", 1))
+    model_state, _ = model_load(os.path.join(args.run_folder, "model.best.pt"), -1)
+    model.load_state_dict(model_state)
+    model.eval()
+
+    ranker_graph = AdvBertRankerGraph(model)
+    ranker_graph.eval()
+
+    #
+    # export
+    #
+    _vocab_size = model._bert.config.vocab_size
+    _query, _document = get_sample_batch(4, _vocab_size, seed=config["seed"])
+    _inputs = prepare_bert_input(_query, _document, _bert_cls_token_id, _bert_sep_token_id, model.max_input_length,
+                                 dynamic_input_length=True, input_length_multiple=model.input_length_multiple)
+
+    print ("Exporting %s graph to %s" % (args.format, args.out_file))
+    with torch.no_grad():
+        if args.format == 'torchscript':
+            _traced = torch.jit.trace(ranker_graph, _inputs)
+            _traced.save(args.out_file)
+        else:
+            _dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"},
+                             "attention_mask": {0: "batch", 1: "sequence"},
+                             "token_type_ids": {0: "batch", 1: "sequence"},
+                             "rels": {0: "batch"}}
+            torch.onnx.export(ranker_graph, _inputs, args.out_file,
+                              input_names=["input_ids", "attention_mask", "token_type_ids"], output_names=["rels"],
+                              dynamic_axes=_dynamic_axes, opset_version=args.onnx_opset)
+
+    #
+    # validation on a sample batch of another batch size and sequence length than the one used for the export
+    #
+    runtime = RankerRuntime(args.out_file, cls_token_id=_bert_cls_token_id, sep_token_id=_bert_sep_token_id,
+                            max_input_length=model.max_input_length,
+                            input_length_multiple=model.input_length_multiple)
+    _query, _document = get_sample_batch(16, _vocab_size, max_doc_length=400, seed=config["seed"] + 1)
+    with torch.no_grad():
+        _rels_model = model.forward(_query, _document, use_adversary=False)["rels"].numpy()
+    _rels_runtime = runtime.score(_query, _document)
+
+    _max_diff = np.max(np.abs(_rels_model - _rels_runtime))
+    print ("Maximum absolute difference of rels to the PyTorch model: %e" % _max_diff)
+    if _max_diff > args.tolerance:
+        raise Exception("Exported ranker deviates from the PyTorch model (%e > %e)" % (_max_diff, args.tolerance))
+    print ("Exported ranker validated")
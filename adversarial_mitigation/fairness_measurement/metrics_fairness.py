@@ -13,6 +13,7 @@ class FaiRRMetric:
             vals = l.strip().split('\t')
             self.documents_neutrality[int(vals[0])] = float(vals[1])
         self.background_doc_set = background_doc_set
+        self._IFaiRR_perq_cache = {} # thresholds -> IFaiRR per threshold and query, the same for every retrieval result
         
     # the normalization term IFaiRR is calculated using the documents of the to retrieval_results
     # retrieval_results : a dictionary with queries and the ordered lists of documents
@@ -30,20 +31,9 @@ class FaiRRMetric:
                     _neutscore = self.documents_neutrality[_docid]
                 else:
                     _neutscore = 1.0
-                    print("WARNING: Document neutrality score of ID %d is not found (set to 1)" % _doc_id)
+                    print("WARNING: Document neutrality score of ID %d is not found (set to 1)" % _docid)
                 _retres_neut[_qryid].append(_neutscore)
         
-        _bachgroundset_neut = {}
-        for _qryid in self.background_doc_set:
-            _bachgroundset_neut[_qryid] = []
-            for _docid in self.background_doc_set[_qryid]:
-                if _docid in self.documents_neutrality:
-                    _neutscore = self.documents_neutrality[_docid]
-                else:
-                    _neutscore = 1.0
-                    print("WARNING: Document neutrality score of ID %d is not found (set to 1)" % _doc_id)
-                _bachgroundset_neut[_qryid].append(_neutscore)
-        
         ## calculate FaiRR
         FaiRR = {}
         FaiRR_perq = {}
@@ -55,14 +45,7 @@ class FaiRRMetric:
             FaiRR[_threshold] = np.mean(list(FaiRR_perq[_threshold].values()))
 
         ## calculate Ideal FaiRR
-        IFaiRR_perq = {}
-        for _qryid in _bachgroundset_neut:
-            _bachgroundset_neut[_qryid].sort(reverse=True)
-        for _threshold in thresholds:
-            IFaiRR_perq[_threshold] = {}
-            for _qryid in _bachgroundset_neut:
-                _th = np.min([len(_bachgroundset_neut[_qryid]), _threshold])
-                IFaiRR_perq[_threshold][_qryid] = np.sum(np.multiply(_bachgroundset_neut[_qryid][:_th], _position_biases[:_th]))
+        IFaiRR_perq = self.calc_IFaiRR_perq(thresholds)
             
         ## calculate Normalized FaiRR
         NFaiRR = {}
@@ -79,6 +62,37 @@ class FaiRRMetric:
         return {'metrics_avg': {'FaiRR': FaiRR, 'NFaiRR': NFaiRR}, 
                 'metrics_perq': {'FaiRR': FaiRR_perq, 'NFaiRR': NFaiRR_perq}}
     
+    # the ideal FaiRR of the background documents, computed once per thresholds (the retrieval results are often 
+    # evaluated in parts, e.g. by query chunks)
+    def calc_IFaiRR_perq(self, thresholds):
+        if tuple(thresholds) in self._IFaiRR_perq_cache:
+            return self._IFaiRR_perq_cache[tuple(thresholds)]
+
+        _position_biases = [1/(np.log2(_rank+1)) for _rank in range(1, np.max(thresholds)+1)]
+
+        _bachgroundset_neut = {}
+        for _qryid in self.background_doc_set:
+            _bachgroundset_neut[_qryid] = []
+            for _docid in self.background_doc_set[_qryid]:
+                if _docid in self.documents_neutrality:
+                    _neutscore = self.documents_neutrality[_docid]
+                else:
+                    _neutscore = 1.0
+                    print("WARNING: Document neutrality score of ID %d is not found (set to 1)" % _docid)
+                _bachgroundset_neut[_qryid].append(_neutscore)
+
+        IFaiRR_perq = {}
+        for _qryid in _bachgroundset_neut:
+            _bachgroundset_neut[_qryid].sort(reverse=True)
+        for _threshold in thresholds:
+            IFaiRR_perq[_threshold] = {}
+            for _qryid in _bachgroundset_neut:
+                _th = np.min([len(_bachgroundset_neut[_qryid]), _threshold])
+                IFaiRR_perq[_threshold][_qryid] = np.sum(np.multiply(_bachgroundset_neut[_qryid][:_th], _position_biases[:_th]))
+
+        self._IFaiRR_perq_cache[tuple(thresholds)] = IFaiRR_perq
+        return IFaiRR_perq
+    
 
 class FaiRRMetricHelper:
 
@@ -112,6 +126,15 @@ class FaiRRMetricHelper:
         
         return retrievalresults
     
+    # the same retrieval results as read_retrievalresults_from_runfile() of the run file that save_sorted_results 
+    # writes for qry_doc_relscores (dict[qid][docid] -> score)
+    def read_retrievalresults_from_relscores(self, qry_doc_relscores, cut_off=200):
+        retrievalresults = {}
+        for _qryid in qry_doc_relscores:
+            _ranked = sorted(qry_doc_relscores[_qryid].items(), key=lambda x: x[1], reverse=True)
+            retrievalresults[int(_qryid)] = [int(_docid) for _docid, _ in _ranked[:cut_off]]
+        return retrievalresults
+    
     def read_documentset_from_retrievalresults(self, trec_run_path):
         _retrivalresults_background = self.read_retrievalresults_from_runfile(trec_run_path)
         background_doc_set = {}
@@ -10,9 +10,13 @@
 #
 # usage:
 # python train.py --run-name experiment1 --config-file configs/knrm.yaml
+#
+# data-parallel training on N cpu ranks (each rank trains on its share of the train_tsv files):
+# torchrun --nproc_per_node N main.py --distributed --run-name experiment1 --config-file configs/knrm.yaml
 
 import argparse
 import copy
+import json
 import os
 import pdb
 import pickle
@@ -27,6 +31,7 @@ import torch
 import torch.optim as optim
 from torch.optim.lr_scheduler import *
 import torch.multiprocessing as mp
+import torch.distributed as dist
 from torch.utils.tensorboard import SummaryWriter
 
 from allennlp.common import Params, Tqdm
@@ -47,7 +52,9 @@ from utils import *
 from evaluation import *
 from multiprocess_input_pipeline import *
 from fairness_measurement.metrics_fairness import FaiRRMetric, FaiRRMetricHelper
-from metrics_utility import EvaluationToolTrec, EvaluationToolMsmarco
+from metrics_utility import EvaluationToolTrec, EvaluationToolTrecNative, EvaluationToolMsmarco
+from attack_features import extract_cls_features, train_adversary_on_features, train_probes_on_features
+from background_validation import BackgroundValidator
 
 Tqdm.default_mininterval = 1
 
@@ -58,50 +65,77 @@ MASK_SYMBOL = "[MASK]"
 def evaluate_validation():
     global best_result_info
     
-    _output_relative_dir = os.path.join(run_folder, "checkpoints/chk%d-%d/" % (epoch, batch_cnt_global))
-    if not os.path.exists(_output_relative_dir):
-        os.makedirs(_output_relative_dir)
-    
-    _result_info, _qry_doc_relscores = evaluate_model(model, config, logger, run_folder, cuda_device,
-                                                      evaluator=evaluator_val,
-                                                      evaluator_fairness=evaluator_fairness,
-                                                      reference_set_rank=reference_set_rank_val, 
-                                                      reference_set_tuple=reference_set_tuple_val,
-                                                      output_files_prefix="",
-                                                      output_relative_dir=_output_relative_dir,
-                                                      testval="validation")
-    
-    for _m in _result_info["metrics_avg"]:
-        tb_writer.add_scalar("val/%s" % _m, _result_info["metrics_avg"][_m], batch_cnt_global)
+    # in distributed training only rank 0 validates and stores the model, the other ranks receive the
+    # metrics (used by the lr scheduler and early stopping, so that all ranks take the same decisions)
+    if distributed_rank > 0:
+        return {"metrics_avg": broadcast_object(None)}
 
-    _metric = config["metric_tocompare"]
-    if ((args.mode in ['debias', 'attack']) or (best_result_info is None) or 
-        (_result_info["metrics_avg"][_metric] > best_result_info["metrics_avg"][_metric])):
-        
-        best_result_info = _result_info
-        
-        # save validation results
-        _best_result_output_path = os.path.join(run_folder, "validation-best-run.txt")
-        _best_result_info_path = os.path.join(run_folder, "validation-best-metrics.txt")
-        _best_result_info_pkl_path = os.path.join(run_folder, "validation-best-metrics.pkl")
-        
-        save_sorted_results(_qry_doc_relscores, _best_result_output_path)    
+    _result_info, best_result_info = validate_and_store_best(model, config, logger, run_folder, cuda_device,
+                                                             validation_set, tb_writer, best_result_info, 
+                                                             epoch, batch_cnt_global, 
+                                                             always_store_best=args.mode in ['debias', 'attack'])
 
-        with open(_best_result_info_path, "w") as fw:
-            fw.write("{'metrics_avg':%s, 'epoch':%d, 'batch_number':%d}" % 
-                     (str(best_result_info["metrics_avg"]), epoch, batch_cnt_global))
-        
-        with open(_best_result_info_pkl_path, "wb") as fw:
-            pickle.dump(best_result_info, fw)
-        
-        # save (best) validation model state
-        logger.info("Saving new model with %s of %.4f at %s" % (_metric, 
-                                                                best_result_info['metrics_avg'][_metric],
-                                                                best_model_store_path))
-        model_save(best_model_store_path, model, best_result_info)
+    if distributed_world_size > 1:
+        broadcast_object(_result_info["metrics_avg"])
 
     return _result_info
+
+#
+# validation during training: evaluated at once, or handed to the background validation process (the results 
+# arrive later through background_validator.poll())
+#
+def request_validation():
+    if background_validator is not None:
+        background_validator.submit(model, epoch, batch_cnt_global)
+        return []
+    return [evaluate_validation()]
+
+#
+# feeds validation results to the lr scheduler and early stopping, returns True if the training should stop
+#
+def apply_validation_results(result_infos):
+    for _result_info in result_infos:
+        if lr_scheduler is not None:
+            lr_scheduler.step(_result_info["metrics_avg"][config["metric_tocompare"]])
+        if early_stopper is not None:
+            if early_stopper.step(_result_info["metrics_avg"][config["metric_tocompare"]]):
+                return True
+    return False
         
+#
+# optimizer step at the end of a gradient accumulation window of window_size batches
+#
+def optimization_step(window_size):
+    # the gradients are unscaled (fp16 loss scaling) before clipping, so that clip_grad_norm_ sees the 
+    # accumulated gradients of all parameters in their true scale
+    if grad_scaler is not None:
+        grad_scaler.unscale_(optimizer_model)
+        grad_scaler.unscale_(optimizer_adv)
+
+    if distributed_world_size > 1:
+        all_reduce_gradients(model.parameters(), distributed_world_size)
+
+    # the losses are divided by accumulation_steps, the mean over a shorter (last) window needs the rest of the factor
+    if window_size != accumulation_steps:
+        for _param in model.parameters():
+            if _param.grad is not None:
+                _param.grad.mul_(accumulation_steps / window_size)
+
+    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+
+    for _optimizer, _modes in [(optimizer_model, ['debias', 'base']), (optimizer_adv, ['debias', 'attack'])]:
+        if args.mode in _modes:
+            if grad_scaler is not None:
+                grad_scaler.step(_optimizer)
+            else:
+                _optimizer.step()
+
+    if grad_scaler is not None:
+        grad_scaler.update()
+
+    optimizer_model.zero_grad()
+    optimizer_adv.zero_grad()
+
 #
 # main process
 # -------------------------------
@@ -118,11 +152,23 @@ if __name__ == "__main__":
     #
     args = get_parser().parse_args()
 
-    run_folder, config = prepare_experiment(args)
-    
-    tb_writer = SummaryWriter(run_folder)
+    distributed_rank, distributed_world_size = 0, 1
+    if args.distributed:
+        distributed_rank, distributed_world_size = init_distributed(args.distributed_timeout)
 
-    logger = get_logger_to_file(run_folder, "main")
+    # the run folder is created by rank 0 and shared with the other ranks
+    if distributed_rank == 0:
+        run_folder, config = prepare_experiment(args)
+    if args.distributed:
+        run_folder, config, args.run_name = broadcast_object((run_folder, config, args.run_name) 
+                                                             if distributed_rank == 0 else None)
+    
+    if distributed_rank == 0:
+        tb_writer = SummaryWriter(run_folder)
+        logger = get_logger_to_file(run_folder, "main")
+    else:
+        tb_writer = SummaryWriter(os.path.join(run_folder, "rank%d" % distributed_rank))
+        logger = get_logger_to_file(run_folder, "main", "log-rank%d.txt" % distributed_rank)
 
     logger.info("Running: %s", str(sys.argv))
     logger.info("Experiment folder: %s", run_folder)
@@ -153,47 +199,61 @@ if __name__ == "__main__":
     else:
         cuda_device = -1
 
+    if args.distributed:
+        if cuda_device != -1:
+            logger.error("Distributed training is only supported on the cpu (gloo backend), run without --cuda")
+            exit(1)
+        # the cores of a node are split between its ranks
+        _threads_per_rank = config.get("distributed_threads_per_rank", -1)
+        if _threads_per_rank == -1:
+            _threads_per_rank = max(1, os.cpu_count() // int(os.environ.get("LOCAL_WORLD_SIZE", distributed_world_size)))
+        torch.set_num_threads(_threads_per_rank)
+        logger.info("Distributed training: rank %d of %d, %d threads", distributed_rank, distributed_world_size,
+                    _threads_per_rank)
+
 
     ###############################################################################
     # Evaluation 
     ###############################################################################
 
-    # utility
+    # only rank 0 validates and tests in distributed training
+    if distributed_rank == 0:
+        # utility
     
-    logger.info('Loading validation qrels and reference set')
-    reference_set_rank_val, reference_set_tuple_val = parse_reference_set(config["validation_candidate_set_path"],
-                                                                          config["evaluation_reranking_cutoff"])
-    evaluator_val = EvaluationToolMsmarco(qrel_path=config["validation_qrels"])
-    #evaluator_val = EvaluationToolTrec(trec_eval_path=config["trec_eval_path"], qrel_path=config["validation_qrels"])
+        logger.info('Loading validation qrels and reference set')
+        reference_set_rank_val, reference_set_tuple_val = parse_reference_set(config["validation_candidate_set_path"],
+                                                                              max(get_reranking_cutoffs(config)))
+        evaluator_val = EvaluationToolMsmarco(qrel_path=config["validation_qrels"])
+        #evaluator_val = EvaluationToolTrec(trec_eval_path=config["trec_eval_path"], qrel_path=config["validation_qrels"])
     
-    logger.info('Loading test qrels and reference set')
-    reference_set_rank_test, reference_set_tuple_test = parse_reference_set(config["test_candidate_set_path"],
-                                                                            config["evaluation_reranking_cutoff"])
-    evaluator_test = EvaluationToolTrec(trec_eval_path=config["trec_eval_path"], qrel_path=config["test_qrels"])
+        logger.info('Loading test qrels and reference set')
+        reference_set_rank_test, reference_set_tuple_test = parse_reference_set(config["test_candidate_set_path"],
+                                                                                max(get_reranking_cutoffs(config)))
+        if config.get("trec_eval_native", False):
+            evaluator_test = EvaluationToolTrecNative(qrel_path=config["test_qrels"])
+        else:
+            evaluator_test = EvaluationToolTrec(trec_eval_path=config["trec_eval_path"], qrel_path=config["test_qrels"])
 
-    # fairness
+        # fairness
     
-    _metrichelper = FaiRRMetricHelper()
-    _background_doc_set = _metrichelper.read_documentset_from_retrievalresults(config["background_runfile_path"])
-    evaluator_fairness = FaiRRMetric(config["collection_neutrality_path"], _background_doc_set)
+        _metrichelper = FaiRRMetricHelper()
+        _background_doc_set = _metrichelper.read_documentset_from_retrievalresults(config["background_runfile_path"])
+        evaluator_fairness = FaiRRMetric(config["collection_neutrality_path"], _background_doc_set)
+
+        validation_set = {"evaluator": evaluator_val, "evaluator_fairness": evaluator_fairness,
+                          "reference_set_rank": reference_set_rank_val, 
+                          "reference_set_tuple": reference_set_tuple_val}
     
     ###############################################################################
     # Load data 
     ###############################################################################
 
     logger.info("Loading BERT")
-    if config["transformers_pretrained_model_id"] == "random":
-        _bert_config_standard = AutoConfig.for_model('bert')
-        bert_config = BertConfig(vocab_size = _bert_config_standard.vocab_size,
-                                 hidden_size = config["bert_hidden_size"], #?
-                                 num_hidden_layers = config["bert_num_layers"],
-                                 num_attention_heads = config["bert_num_heads"],
-                                 intermediate_size = config["bert_intermediate_size"],
-                                 hidden_dropout_prob = config["bert_dropout"], #!
-                                 attention_probs_dropout_prob = config["bert_dropout"])
-        transformer_embedder = BertModel(bert_config)
-    else:
-        transformer_embedder = BertModel.from_pretrained(config["transformers_pretrained_model_id"], cache_dir="cache")
+    transformer_embedder = get_bert_model(config)
+    if config.get("activation_checkpoint_every_n_layers", 0) > 0:
+        _checkpointed_layers = enable_activation_checkpointing(transformer_embedder,
+                                                               config["activation_checkpoint_every_n_layers"])
+        logger.info("Activation checkpointing of the BERT layers %s", str(_checkpointed_layers))
     _bert_tokenizer = BertTokenizer.from_pretrained(config["transformers_pretrained_model_id"])
     _bert_cls_token_id = _bert_tokenizer.vocab[_bert_tokenizer.cls_token]
     _bert_sep_token_id = _bert_tokenizer.vocab[_bert_tokenizer.sep_token]
@@ -203,7 +263,9 @@ if __name__ == "__main__":
     ###############################################################################
 
     model = AdvBert(bert = transformer_embedder, adv_rev_factor=config["adv_rev_factor"],
-                    cls_token_id=_bert_cls_token_id, sep_token_id=_bert_sep_token_id)
+                    cls_token_id=_bert_cls_token_id, sep_token_id=_bert_sep_token_id,
+                    dynamic_input_length=config.get("dynamic_input_length", False),
+                    input_length_multiple=config.get("input_length_multiple", 1))
     
     if cuda_device != -1:
         model.cuda(cuda_device)
@@ -244,6 +306,13 @@ if __name__ == "__main__":
                     _loaded_params_name.append(_param_name)
             logger.info('Loaded pretrained parameter state_dict %s' % str(_loaded_params_name))
 
+        if args.distributed:
+            # all ranks start from the parameters of rank 0, afterwards the ranks use different random 
+            # states (dropout) for their data shards
+            broadcast_model_state(model)
+            np.random.seed(config["seed"] + distributed_rank)
+            torch.manual_seed(config["seed"] + distributed_rank)
+
         #
         # optimization
         #    
@@ -299,6 +368,27 @@ if __name__ == "__main__":
             if (criterion_adversary is not None):
                 criterion_adversary.cuda(cuda_device)
         
+        #
+        # mixed precision & gradient accumulation
+        #
+        autocast_device = "cuda" if cuda_device != -1 else "cpu"
+        autocast_dtype = None
+        if config.get("mixed_precision", "none") == "bf16":
+            autocast_dtype = torch.bfloat16
+        elif config.get("mixed_precision", "none") == "fp16":
+            if cuda_device != -1:
+                autocast_dtype = torch.float16
+            else:
+                logger.warning("fp16 autocast is not available on the cpu, using bf16 instead")
+                autocast_dtype = torch.bfloat16
+        
+        grad_scaler = None
+        if autocast_dtype == torch.float16: # bf16 has the range of fp32, no loss scaling needed
+            grad_scaler = torch.cuda.amp.GradScaler()
+
+        accumulation_steps = int(config.get("gradient_accumulation_steps", 1))
+        accumulated_batch_cnt = 0
+
         #
         # training / saving / validation loop
         # -------------------------------
@@ -309,18 +399,60 @@ if __name__ == "__main__":
         logger.info('-' * 89)
 
         best_result_info = None 
+        optimizer_model.zero_grad()
+        optimizer_adv.zero_grad()
         training_batch_size = int(config["batch_size_train"])
         validate_every_n_batches = config["validate_every_n_batches"]
         # helper vars for quick checking if we should validate during the epoch
         do_validate_every_n_batches = validate_every_n_batches > -1
         loss_sum_model = 0
         loss_sum_adv = 0
+        step_time_sum = 0
+        step_cnt = 0
         data_cnt_all = 0
         training_processes = []
         batch_cnt_global = 0
+        training_epochs = int(config["epochs"])
+
+        #
+        # attack on the cached [CLS] vectors of the frozen ranker, replaces the training loop
+        #
+        if (args.mode == 'attack') and config.get("attack_cached_features", False):
+            if args.distributed:
+                logger.error("attack_cached_features is not supported in distributed training")
+                exit(1)
+            logger.info('Extracting [CLS] vectors of the training data with the frozen ranker')
+            _features, _labels = extract_cls_features(model, cuda_device, config, logger, run_folder)
+            batch_cnt_global = train_adversary_on_features(model, _features, _labels, optimizer_adv, criterion_adversary,
+                                                           cuda_device, config, logger, tb_writer)
+            
+            if len(config.get("attack_probe_hidden_sizes", [])) > 0:
+                logger.info('Training the adversary probes')
+                _validation_features, _validation_labels = extract_cls_features(model, cuda_device, config, logger,
+                                                                                run_folder, split="validation")
+                _probes_results = train_probes_on_features(_features, _labels, _validation_features, _validation_labels,
+                                                           config, cuda_device, logger)
+                for _m in ["adv_accuracy_mean", "adv_accuracy_var", "adv_accuracy_max"]:
+                    tb_writer.add_scalar("val/probes_%s" % _m, _probes_results[_m], batch_cnt_global)
+                with open(os.path.join(run_folder, "attack-probes-metrics.json"), "w") as fw:
+                    json.dump(_probes_results, fw, indent=2)
+            epoch = 0
+            evaluate_validation()
+            training_epochs = 0
+
+        #
+        # background validation: the training continues while snapshots of the model are validated
+        #
+        background_validator = None
+        if config.get("background_validation", False) and training_epochs > 0:
+            if args.distributed:
+                logger.error("background_validation is not supported in distributed training")
+                exit(1)
+            background_validator = BackgroundValidator(model, config, logger, run_folder, cuda_device, validation_set,
+                                                       always_store_best=args.mode in ['debias', 'attack'])
 
         try:
-            for epoch in range(0, int(config["epochs"])):
+            for epoch in range(0, training_epochs):
                 if early_stopper is not None:
                     if early_stopper.stop:
                         break
@@ -329,11 +461,17 @@ if __name__ == "__main__":
                 # -------------------------------
                 #
                 train_files = glob.glob(config.get("train_tsv"))
-                training_queue, training_processes, train_exit = get_multiprocess_batch_queue("train-batches-" + str(epoch),
-                                                                                              multiprocess_training_loader,
-                                                                                              files=train_files,
-                                                                                              conf=config,
-                                                                                              _logger=logger)
+                if args.distributed:
+                    # each rank owns a shard of the training files
+                    train_files = sorted(train_files)[distributed_rank::distributed_world_size]
+                    if len(train_files) == 0:
+                        logger.error("Distributed training needs at least as many train_tsv files as ranks")
+                        exit(1)
+                training_queue, training_processes, train_exit, training_loader_stats = get_multiprocess_batch_queue("train-batches-" + str(epoch),
+                                                                                                                   multiprocess_training_loader,
+                                                                                                                   files=train_files,
+                                                                                                                   conf=config,
+                                                                                                                   _logger=logger)
                 
                 model.train()  # only has an effect, if we use dropout & regularization layers in the model definition...
                 #time.sleep(len(training_processes))  # fill the queue
@@ -350,21 +488,24 @@ if __name__ == "__main__":
                 # do validation at the begining
                 if "save_test_during_validation" in config:
                     if config["save_test_during_validation"]:
-                        evaluate_validation()    
+                        request_validation()
 
                 while (True):
                     
                     #
                     # prepare batch
                     #
-                    batch = training_queue.get()
+                    batch = training_loader_stats.timed_get(training_queue)
                     if batch is None:
                         batch_null_cnt += 1
-                        if batch_null_cnt == len(train_files):
-                            break
-                        else:
+                        if batch_null_cnt < len(train_files):
                             continue
-                    if i >= max_training_batch_count and max_training_batch_count != -1:
+                    _epoch_finished = (batch is None) or (i >= max_training_batch_count and max_training_batch_count != -1)
+                    # in distributed training, all ranks finish the epoch as soon as one rank's shard is exhausted,
+                    # so that the ranks do the same number of optimizer steps
+                    if args.distributed:
+                        _epoch_finished = distributed_any(_epoch_finished)
+                    if _epoch_finished:
                         break
                     batch_cnt_global += 1
 
@@ -381,53 +522,54 @@ if __name__ == "__main__":
                     #
                     # feed forward
                     #
-                    optimizer_model.zero_grad()
-                    optimizer_adv.zero_grad()
-
-                    output_pos_dict = model.forward(batch["query_tokens"], batch["doc_pos_tokens"])
-                    output_pos = output_pos_dict["rels"]
-
-                    output_neg_dict = model.forward(batch["query_tokens"], batch["doc_neg_tokens"])
-                    output_neg = output_neg_dict["rels"]
+                    _step_start_time = time.perf_counter()
+                    with torch.autocast(device_type=autocast_device, dtype=autocast_dtype or torch.bfloat16,
+                                        enabled=autocast_dtype is not None):
+                        output_pos_dict, output_neg_dict = model.forward_paired(batch["query_tokens"], batch["doc_pos_tokens"],
+                                                                                batch["doc_neg_tokens"])
+                        output_pos = output_pos_dict["rels"]
+                        output_neg = output_neg_dict["rels"]
                     
-                    #
-                    # loss & optimization
-                    #
-                    loss_model = None 
-                    if args.mode in ['debias', 'base']:
-                        if config["loss_model"] == "maxmargin":
-                            labels = torch.ones(current_batch_size)
-                            if cuda_device != -1:
-                                labels = labels.cuda(cuda_device)
-                            loss_model = criterion(output_pos, output_neg, labels)
-                        elif config["loss_model"] == "crossentropy":
-                            outputs = output_pos_dict["logprobs"][:,0] + output_neg_dict["logprobs"][:,1]
-                            loss_model = - torch.mean(outputs)
+                        #
+                        # loss & optimization
+                        #
+                        loss_model = None 
+                        if args.mode in ['debias', 'base']:
+                            if config["loss_model"] == "maxmargin":
+                                labels = torch.ones(current_batch_size)
+                                if cuda_device != -1:
+                                    labels = labels.cuda(cuda_device)
+                                loss_model = criterion(output_pos, output_neg, labels)
+                            elif config["loss_model"] == "crossentropy":
+                                outputs = output_pos_dict["logprobs"][:,0] + output_neg_dict["logprobs"][:,1]
+                                loss_model = - torch.mean(outputs)
+                            else:
+                                logger.error("Model loss function %s not known", config["loss_model"])
+                                exit(1)
+
+
+                        loss_adv = None    
+                        if args.mode in ['debias', 'attack']:
+                            loss_adv = criterion_adversary(output_pos_dict["adv_logprobs"], batch["protected_label_pos"])
+                            loss_adv += criterion_adversary(output_neg_dict["adv_logprobs"], batch["protected_label_neg"])
+
+                        if loss_model is None:
+                            loss = loss_adv
+                        elif loss_adv is None:
+                            loss = loss_model
                         else:
-                            logger.error("Model loss function %s not known", config["loss_model"])
-                            exit(1)
-
+                            loss = loss_model + loss_adv
 
-                    loss_adv = None    
-                    if args.mode in ['debias', 'attack']:
-                        loss_adv = criterion_adversary(output_pos_dict["adv_logprobs"], batch["protected_label_pos"])
-                        loss_adv += criterion_adversary(output_neg_dict["adv_logprobs"], batch["protected_label_neg"])
-
-                    if loss_model is None:
-                        loss = loss_adv
-                    elif loss_adv is None:
-                        loss = loss_model
+                    # the gradients of <accumulation_steps> batches are accumulated before an optimizer step
+                    if grad_scaler is not None:
+                        grad_scaler.scale(loss / accumulation_steps).backward()
                     else:
-                        loss = loss_model + loss_adv
-
-                    loss.backward()
-
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-
-                    if args.mode in ['debias', 'base']:
-                        optimizer_model.step()
-                    if args.mode in ['debias', 'attack']:
-                        optimizer_adv.step()
+                        (loss / accumulation_steps).backward()
+                    
+                    accumulated_batch_cnt += 1
+                    if accumulated_batch_cnt == accumulation_steps:
+                        optimization_step(accumulated_batch_cnt)
+                        accumulated_batch_cnt = 0
 
                         
                     #
@@ -439,41 +581,56 @@ if __name__ == "__main__":
                         loss_sum_adv += loss_adv.item()
                     
                     tb_writer.add_scalar("train/loss", loss.item(), batch_cnt_global)
+                    step_time_sum += time.perf_counter() - _step_start_time # .item() waits for the step to finish
+                    step_cnt += 1
                     if (i % config["log_interval"] == 0) and (i != 0):
                         cur_loss_model = loss_sum_model / float(data_cnt_all)
                         cur_loss_adv = loss_sum_adv / float(data_cnt_all)
+                        cur_step_time = step_time_sum / float(step_cnt)
+                        peak_memory = get_peak_memory_mb(cuda_device)
                         
-                        logger.info('| TRAIN | %s | epoch %3d | %5d batches | lrs %s %s | avg. loss %.5f %.5f' %
+                        logger.info('| TRAIN | %s | epoch %3d | %5d batches | lrs %s %s | avg. loss %.5f %.5f | step %.3fs | peak memory %.0f MB' %
                                     (args.run_name, epoch, i, str(['%02.6f' % pg['lr'] for pg in optimizer_model.param_groups]), 
                                      str(['%02.6f' % pg['lr'] for pg in optimizer_adv.param_groups]), 
-                                     cur_loss_model, cur_loss_adv))
+                                     cur_loss_model, cur_loss_adv, cur_step_time, peak_memory))
+                        tb_writer.add_scalar("train/step_time", cur_step_time, batch_cnt_global)
+                        tb_writer.add_scalar("train/peak_memory_mb", peak_memory, batch_cnt_global)
+                        step_time_sum = 0
+                        step_cnt = 0
 
                         # make sure that the perf of the queue is sustained
                         if training_queue.qsize() < 10:
                             logger.warning("training_queue.qsize() < 10 (%d)" % training_queue.qsize())
+                        training_loader_stats.write_tensorboard(tb_writer, "train_loader", batch_cnt_global)
                         
-                    if config["checkpoint_interval"] != -1 and i % config["checkpoint_interval"] == 0 and i > 0:
+                    if (config["checkpoint_interval"] != -1 and i % config["checkpoint_interval"] == 0 and i > 0 and
+                        distributed_rank == 0):
                         logger.info("saving checkpoint at epoch %3d and %5d batches" % (epoch, i))
                         checkpoint_save(checkpoint_model_store_path, model, criterion, optimizer_model, epoch, i)
 
                     #
                     # validation (inside epoch) - if so configured
                     #
+                    _result_infos = []
                     if do_validate_every_n_batches:
                         if i > 0 and i % validate_every_n_batches == 0:
-                            _result_info = evaluate_validation()
+                            _result_infos = request_validation()
                             
                             # coming back to training mode
                             model.train()
-                            if lr_scheduler is not None:
-                                lr_scheduler.step(_result_info["metrics_avg"][config["metric_tocompare"]])
-                            if early_stopper is not None:
-                                if early_stopper.step(_result_info["metrics_avg"][config["metric_tocompare"]]):
-                                    logger.info("early stopping epoch %d batch count %d" % (epoch, i))
-                                    break
+                    if background_validator is not None:
+                        _result_infos += background_validator.poll()
+                    if apply_validation_results(_result_infos):
+                        logger.info("early stopping epoch %d batch count %d" % (epoch, i))
+                        break
                             
                     i += 1 #next batch
 
+                # optimizer step on the rest of the last accumulation window
+                if accumulated_batch_cnt > 0:
+                    optimization_step(accumulated_batch_cnt)
+                    accumulated_batch_cnt = 0
+
                 # make sure we didn't make a mistake in the configuration / data preparation
                 if training_queue.qsize() != 0 and config["max_training_batch_count"] == -1:
                     logger.error("training_queue.qsize() is not empty after epoch "+str(epoch))
@@ -486,7 +643,19 @@ if __name__ == "__main__":
                              str(['%02.6f' % pg['lr'] for pg in optimizer_adv.param_groups]),
                              cur_loss_model, cur_loss_adv))
                 
-                if config["checkpoint_interval"] != -1:
+                ## logging loader throughput
+                _loader_stats_summary = training_loader_stats.summary()
+                logger.info('| TRAIN | %s | epoch %3d | loader %.1f lines/s | waiting on the queue %.2f%% of the time' %
+                            (args.run_name, epoch, _loader_stats_summary["lines_per_sec"], 
+                             _loader_stats_summary["consumer_wait_fraction"] * 100))
+                # every rank has its own loaders
+                _loader_stats_file = "train-loader-stats-epoch%d.json" % epoch
+                if distributed_world_size > 1:
+                    _loader_stats_file = "train-loader-stats-epoch%d-rank%d.json" % (epoch, distributed_rank)
+                with open(os.path.join(run_folder, _loader_stats_file), "w") as fw:
+                    json.dump(_loader_stats_summary, fw, indent=2)
+
+                if config["checkpoint_interval"] != -1 and distributed_rank == 0:
                     logger.info("saving checkpoint at epoch %d after %d batches" % (epoch, i))
                     checkpoint_save(checkpoint_model_store_path, model, criterion, optimizer_model, epoch, i)
 
@@ -499,13 +668,13 @@ if __name__ == "__main__":
                 #
                 # validation (at the end of epoch)
                 #
-                _result_info = evaluate_validation()
-                if lr_scheduler is not None:
-                    lr_scheduler.step(_result_info["metrics_avg"][config["metric_tocompare"]])
-                if early_stopper is not None:
-                    if early_stopper.step(_result_info["metrics_avg"][config["metric_tocompare"]]):
-                        logger.info("early stopping epoch %d" % epoch)
-                        break
+                if apply_validation_results(request_validation()):
+                    logger.info("early stopping epoch %d" % epoch)
+                    break
+
+            # the test uses the best model, which is stored by the last validations
+            if background_validator is not None:
+                background_validator.finish()
 
         except Exception as e:
             logger.exception('[train] Got exception: %s' % str(e))
@@ -514,6 +683,8 @@ if __name__ == "__main__":
             for proc in training_processes:
                 if proc.is_alive():
                     proc.terminate()
+            if background_validator is not None:
+                background_validator.terminate()
             exit(1)
 
         logger.info('Training Finished!')
@@ -522,7 +693,7 @@ if __name__ == "__main__":
     ###############################################################################
     # Test
     ###############################################################################
-    if args.mode in ['debias', 'attack', 'base', 'test']:
+    if args.mode in ['debias', 'attack', 'base', 'test'] and distributed_rank == 0:
         #
         # evaluate the test set with the best model
         #
@@ -533,8 +704,7 @@ if __name__ == "__main__":
 
         logger.info('Loading best model')
 
-        _cuda_device = int(args.cuda_device_id)
-        model_state, best_result_info_val = model_load(best_model_store_path, _cuda_device)
+        model_state, best_result_info_val = model_load(best_model_store_path, cuda_device)
         model.load_state_dict(model_state)
 
         logger.info("Testing the model")
@@ -552,6 +722,11 @@ if __name__ == "__main__":
             tb_writer.add_scalar("test/%s" % _m, _result_info["metrics_avg"][_m], 0)
 
 
+    # run files that are still written in the background
+    wait_for_saved_results()
+
+    if args.distributed:
+        dist.destroy_process_group()
     
     logger.info('Fertig!')
     
@@ -5,14 +5,54 @@ import pdb
 import pickle
 import argparse
 
+import numpy as np
+
 MAX_MRR_RANK = 200
 
+
+#
+# helpers for rows that are grouped by query (the rows of a query are consecutive)
+#
+def _group_starts_lengths(group_index):
+    if len(group_index) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _group_starts = np.concatenate([[0], np.flatnonzero(np.diff(group_index)) + 1]).astype(np.int64)
+    _group_lengths = np.diff(np.concatenate([_group_starts, [len(group_index)]]))
+    return _group_starts, _group_lengths
+
+# 0-based position of each row inside its group
+def ranks_in_groups(group_index):
+    _group_starts, _group_lengths = _group_starts_lengths(group_index)
+    return np.arange(len(group_index)) - np.repeat(_group_starts, _group_lengths)
+
+def cumsum_in_groups(values, group_index):
+    _group_starts, _group_lengths = _group_starts_lengths(group_index)
+    _cumsum = np.cumsum(values)
+    return _cumsum - np.repeat(_cumsum[_group_starts] - values[_group_starts], _group_lengths)
+
+
+# stable ascending order of the values inside each group (the groups stay in order), sorted as rows of a padded 
+# (groups, longest group) matrix, which is much faster than a lexsort over all rows
+def argsort_in_groups(values, group_index):
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    _group_starts, _group_lengths = _group_starts_lengths(group_index)
+    _padded = np.full((len(_group_starts), _group_lengths.max()), np.inf)
+    _padded[np.repeat(np.arange(len(_group_starts)), _group_lengths), ranks_in_groups(group_index)] = values
+    _order = np.argsort(_padded, axis=1, kind="stable")
+    return (_order + _group_starts[:, None])[_order < _group_lengths[:, None]]
+
+
 class EvaluationTool():
     def __init__(self):
         pass
     
     def evaluate(self, candidate, run_path_for_save, evalparam="-q", validaterun=False):
         pass
+
+    # the query ids (str) that have qrels, only these queries are evaluated
+    def get_qids_with_qrels(self):
+        pass
         
 class EvaluationToolTrec(EvaluationTool):
     
@@ -21,7 +61,14 @@ class EvaluationToolTrec(EvaluationTool):
         self.trec_eval_path = trec_eval_path
         self.qrel_path = qrel_path
         self.trec_measures_param = trec_measures_param
+        self._qids_with_qrels = None
         
+    def get_qids_with_qrels(self):
+        if self._qids_with_qrels is None:
+            with open(self.qrel_path, 'r') as f:
+                self._qids_with_qrels = set(l.split()[0] for l in f if l.strip())
+        return self._qids_with_qrels
+
     def run_command(self, command):
         #p = subprocess.Popen(command.split(),
         #                     stdout=subprocess.PIPE,
@@ -95,17 +142,159 @@ class EvaluationToolTrec(EvaluationTool):
                     
         return results_avg, results_perq
 
+
+
+class EvaluationToolTrecNative(EvaluationTool):
+    """
+    in-process, vectorized implementation of the trec_eval measures ndcg, ndcg_cut, recall, P, map and recip_rank.
+    follows trec_eval: the documents of a query are ranked by score, ties by doc id (both descending), only the 
+    queries of the run that have qrels are evaluated, relevant means a relevance level >= 1 and the gain of ndcg is 
+    the relevance level. the scores are rounded to the precision of the run files (score_precision decimals), so that 
+    the ties are the same as in the trec_eval evaluation of a saved run
+    """
+    def __init__(self, qrel_path, measures=("ndcg", "ndcg_cut", "recall", "P", "map", "recip_rank"),
+                 cutoffs=(5, 10, 15, 20, 30, 100, 200, 500, 1000), score_precision=6):
+        self.qrel_path = qrel_path
+        self.measures = measures
+        self.cutoffs = cutoffs
+        self.score_precision = score_precision
+        self.qrels = self.load_qrels(qrel_path)
+
+        # qrels as sorted "qid docid" keys with their relevance levels, for the vectorized lookup of the run rows
+        _keys = [qid + " " + docid for qid in self.qrels for docid in self.qrels[qid]]
+        _levels = [self.qrels[qid][docid] for qid in self.qrels for docid in self.qrels[qid]]
+        _order = np.argsort(_keys)
+        self._qrel_keys = np.array(_keys)[_order]
+        self._qrel_levels = np.array(_levels, dtype=np.float64)[_order]
+    
+    def load_qrels(self, qrel_path):
+        qrels = {} # dict[qid][docid] -> relevance level
+        with open(qrel_path, 'r') as f:
+            for l in f:
+                vals = l.strip().split()
+                if len(vals) != 4:
+                    raise IOError('\"%s\" is not valid format' % l)
+                if vals[0] not in qrels:
+                    qrels[vals[0]] = {}
+                qrels[vals[0]][vals[2]] = int(vals[3])
+        return qrels
+
+    def get_qids_with_qrels(self):
+        return self.qrels.keys()
+
+    def evaluate(self, candidate, run_path_for_save=None, evalparam="-q", validaterun=False):
+        _query_ids = [str(qid) for qid in candidate for docid in candidate[qid]]
+        _doc_ids = [str(docid) for qid in candidate for docid in candidate[qid]]
+        _scores = [candidate[qid][docid] for qid in candidate for docid in candidate[qid]]
+        return self.evaluate_arrays(_query_ids, _doc_ids, _scores)
+
+    def evaluate_from_file(self, candidate_path, evalparam="-q", validaterun=False):
+        _query_ids, _doc_ids, _scores = [], [], []
+        with open(candidate_path, 'r') as f:
+            for l in f:
+                vals = l.strip().split()
+                _query_ids.append(vals[0])
+                _doc_ids.append(vals[2])
+                _scores.append(float(vals[4]))
+        return self.evaluate_arrays(_query_ids, _doc_ids, _scores, score_precision=None)
+
+    def evaluate_arrays(self, query_ids, doc_ids, scores, score_precision=-1):
+        if score_precision == -1:
+            score_precision = self.score_precision
+        query_ids = np.asarray(query_ids).astype(str)
+        doc_ids = np.asarray(doc_ids).astype(str)
+        scores = np.asarray(scores, dtype=np.float64)
+        if score_precision is not None:
+            scores = np.round(scores, score_precision)
+
+        # only the queries with qrels
+        _judged = np.isin(query_ids, list(self.qrels.keys()))
+        query_ids, doc_ids, scores = query_ids[_judged], doc_ids[_judged], scores[_judged]
+        if len(query_ids) == 0:
+            raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
+
+        # ranking: query, score descending, doc id descending
+        _qids, _query_index = np.unique(query_ids, return_inverse=True)
+        _, _doc_index = np.unique(doc_ids, return_inverse=True)
+        _order = np.lexsort((-_doc_index, -scores, _query_index))
+        query_index = _query_index[_order]
+        _run_keys = np.char.add(np.char.add(query_ids[_order], " "), doc_ids[_order])
+        _ranks = ranks_in_groups(query_index)
+
+        # relevance levels of the ranked documents (0 for unjudged)
+        _positions = np.minimum(np.searchsorted(self._qrel_keys, _run_keys), len(self._qrel_keys) - 1)
+        _levels = np.where(self._qrel_keys[_positions] == _run_keys, self._qrel_levels[_positions], 0.0)
+        _relevant = (_levels >= 1).astype(np.float64)
+        _gains = np.maximum(_levels, 0.0)
+        _discounted_gains = _gains / np.log2(_ranks + 2.0)
+
+        # per query: number of relevant documents and the ideal ranking of the qrels' gains
+        _query_count = len(_qids)
+        _num_rel = np.array([sum(1 for _level in self.qrels[qid].values() if _level >= 1) for qid in _qids], 
+                            dtype=np.float64)
+        _ideal_gains = [sorted([_level for _level in self.qrels[qid].values() if _level > 0], reverse=True) 
+                        for qid in _qids]
+        _ideal_query_index = np.repeat(np.arange(_query_count), [len(_g) for _g in _ideal_gains])
+        _ideal_gains = np.array([_gain for _g in _ideal_gains for _gain in _g], dtype=np.float64)
+        _ideal_ranks = ranks_in_groups(_ideal_query_index)
+        _ideal_discounted_gains = _ideal_gains / np.log2(_ideal_ranks + 2.0)
+
+        def _per_query_sum(index, values):
+            return np.bincount(index, weights=values, minlength=_query_count)
+
+        def _safe_divide(a, b):
+            return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+        results_perq_arrays = {}
+        if "map" in self.measures:
+            _relevant_cumsum = cumsum_in_groups(_relevant, query_index)
+            results_perq_arrays["map"] = _safe_divide(_per_query_sum(query_index, _relevant * _relevant_cumsum / 
+                                                                     (_ranks + 1.0)), _num_rel)
+        if "recip_rank" in self.measures:
+            _first_relevant = np.full(_query_count, np.inf)
+            np.minimum.at(_first_relevant, query_index[_relevant > 0], _ranks[_relevant > 0])
+            results_perq_arrays["recip_rank"] = 1.0 / (_first_relevant + 1.0)
+        if "ndcg" in self.measures:
+            results_perq_arrays["ndcg"] = _safe_divide(_per_query_sum(query_index, _discounted_gains),
+                                                       _per_query_sum(_ideal_query_index, _ideal_discounted_gains))
+        for _cutoff in self.cutoffs:
+            _in_cutoff = _ranks < _cutoff
+            if "P" in self.measures:
+                results_perq_arrays["P_%d" % _cutoff] = _per_query_sum(query_index, _relevant * _in_cutoff) / _cutoff
+            if "recall" in self.measures:
+                results_perq_arrays["recall_%d" % _cutoff] = _safe_divide(_per_query_sum(query_index, 
+                                                                                         _relevant * _in_cutoff), 
+                                                                          _num_rel)
+            if "ndcg_cut" in self.measures:
+                _ideal_in_cutoff = _ideal_ranks < _cutoff
+                results_perq_arrays["ndcg_cut_%d" % _cutoff] = _safe_divide(
+                    _per_query_sum(query_index, _discounted_gains * _in_cutoff),
+                    _per_query_sum(_ideal_query_index, _ideal_discounted_gains * _ideal_in_cutoff))
+
+        results_avg = {}
+        results_perq = {}
+        for _metric, _values in results_perq_arrays.items():
+            results_avg[_metric] = float(np.mean(_values))
+            results_perq[_metric] = dict(zip(_qids.tolist(), _values.tolist()))
+        return results_avg, results_perq
+
     
 class EvaluationToolMsmarco(EvaluationTool):
     
-    def __init__(self, qrel_path):
+    def __init__(self, qrel_path, mrr_depths=(10,)):
         self.qrel_path = qrel_path
         self.qids_to_relevant_docids = self.load_reference(self.qrel_path)
+        # recip_rank is MRR@MAX_MRR_RANK, recip_rank_<depth> are computed in the same call
+        self.mrr_depths = mrr_depths
+
+        # sorted "qid docid" keys of the relevant documents, for the vectorized membership test
+        self._relevant_keys = np.sort(np.array([qid + " " + docid for qid in self.qids_to_relevant_docids 
+                                                for docid in self.qids_to_relevant_docids[qid]], dtype=str))
         
     def load_reference_from_stream(self, f):
         """Load Reference reference relevant documents
         Args:f (stream): stream to load.
-        Returns:qids_to_relevant_docids (dict): dictionary mapping from query_id (int) to relevant documents (list of ints). 
+        Returns:qids_to_relevant_docids (dict): dictionary mapping from query_id (str) to relevant documents (set of str). 
         """
         qids_to_relevant_docids = {}
         for l in f:
@@ -120,51 +309,57 @@ class EvaluationToolMsmarco(EvaluationTool):
             if qid in qids_to_relevant_docids:
                 pass
             else:
-                qids_to_relevant_docids[qid] = []
+                qids_to_relevant_docids[qid] = set()
             _rel = int(vals[3])
             if _rel > 0:
-                qids_to_relevant_docids[qid].append(vals[2])
+                qids_to_relevant_docids[qid].add(vals[2])
 
         return qids_to_relevant_docids
 
     def load_reference(self, path_to_reference):
         """Load Reference reference relevant documents
         Args:path_to_reference (str): path to a file to load.
-        Returns:qids_to_relevant_docids (dict): dictionary mapping from query_id (int) to relevant documents (list of ints). 
+        Returns:qids_to_relevant_docids (dict): dictionary mapping from query_id (str) to relevant documents (set of str). 
         """
         with open(path_to_reference,'r') as f:
             qids_to_relevant_docids = self.load_reference_from_stream(f)
         return qids_to_relevant_docids
 
+    def get_qids_with_qrels(self):
+        return self.qids_to_relevant_docids.keys()
+
     def evaluate(self, candidate, run_path_for_save, evalparam=None, validaterun=False):
         
         """Compute MRR metric
         """
-        results_perq = {'recip_rank':{}}
-        results_avg = {'recip_rank':{}}
-        MRR = 0
-        ranking = []
-        for qid in candidate:
-            if qid in self.qids_to_relevant_docids:
-                target_docid = self.qids_to_relevant_docids[qid]
-                candidate_docidscore = list(candidate[qid].items())
-                candidate_docidscore.sort(key=lambda x: x[1], reverse=True)
-                candidate_docid = [x[0] for x in candidate_docidscore]
-                ranking.append(0)
-                results_perq['recip_rank'][qid] = 0
-                # MRR
-                for i in range(0, min(len(candidate_docid), MAX_MRR_RANK)):
-                    if candidate_docid[i] in target_docid:
-                        MRR += 1/(i + 1)
-                        results_perq['recip_rank'][qid] = 1/(i + 1)
-                        ranking.pop()
-                        ranking.append(i+1)
-                        break
-                
-        if len(ranking) == 0:
+        _qids = [qid for qid in candidate if qid in self.qids_to_relevant_docids]
+        if len(_qids) == 0:
             raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
+        
+        # all candidates as one array, ranked by query, score descending and (for ties) the order in candidate
+        _lengths = [len(candidate[qid]) for qid in _qids]
+        _query_index = np.repeat(np.arange(len(_qids)), _lengths)
+        _scores = np.fromiter((_score for qid in _qids for _score in candidate[qid].values()), dtype=np.float64,
+                              count=len(_query_index))
+        _order = np.lexsort((np.arange(len(_query_index)), -_scores, _query_index))
+        _ranks = ranks_in_groups(_query_index) # the rows of a query are consecutive before and after sorting
+        
+        # membership of the top MAX_MRR_RANK documents in the relevant documents
+        _keys = np.array([str(qid) + " " + str(docid) for qid in _qids for docid in candidate[qid]], dtype=str)
+        _top = _order[_ranks < MAX_MRR_RANK]
+        _top_ranks = _ranks[_ranks < MAX_MRR_RANK]
+        _positions = np.minimum(np.searchsorted(self._relevant_keys, _keys[_top]), max(len(self._relevant_keys) - 1, 0))
+        _relevant = (self._relevant_keys[_positions] == _keys[_top]) if len(self._relevant_keys) > 0 else \
+                    np.zeros(len(_top), dtype=bool)
+        
+        _first_relevant_rank = np.full(len(_qids), np.inf)
+        np.minimum.at(_first_relevant_rank, _query_index[_top][_relevant], _top_ranks[_relevant])
 
-        results_avg['recip_rank'] = MRR/len(ranking)
+        results_perq = {}
+        results_avg = {}
+        for _metric, _depth in [('recip_rank', MAX_MRR_RANK)] + [('recip_rank_%d' % _d, _d) for _d in self.mrr_depths]:
+            _recip_ranks = np.where(_first_relevant_rank < _depth, 1.0 / (_first_relevant_rank + 1), 0.0)
+            results_perq[_metric] = dict(zip(_qids, _recip_ranks.tolist()))
+            results_avg[_metric] = float(np.mean(_recip_ranks))
         
         return results_avg, results_perq
-
@@ -10,11 +10,15 @@ from torch import Tensor
 from torch.autograd import Function
 from torch.nn.modules.linear import Linear
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from allennlp.models import Model
 from allennlp.nn import util
 
-from transformers import BertModel
+from transformers import BertModel, BertConfig, AutoConfig
+from transformers.models.bert.modeling_bert import BertLayer
+
+from bert_input import prepare_bert_input
 
 
 class PositionalEncoding(torch.nn.Module):
@@ -57,12 +61,17 @@ class AdvBert(Model):
                  bert: BertModel,
                  adv_rev_factor = 1.0,
                  cls_token_id=101, 
-                 sep_token_id=102):
+                 sep_token_id=102,
+                 dynamic_input_length=False,
+                 input_length_multiple=1):
         super(AdvBert, self).__init__(vocab=None) # (?)
         
         self.cls_token_id = cls_token_id
         self.sep_token_id = sep_token_id
         self.max_input_length = 512
+        # if set, the input is sized to the longest sequence of the batch (rounded up to input_length_multiple)
+        self.dynamic_input_length = dynamic_input_length
+        self.input_length_multiple = input_length_multiple
         
         self._bert = bert
         self._embedding_size = self._bert.config.hidden_size 
@@ -75,64 +84,164 @@ class AdvBert(Model):
             torch.nn.Linear(self._embedding_size, 2, bias=True))
         
         
-    def forward(self, query: torch.Tensor, document: torch.Tensor) -> torch.Tensor:
-        tok_seq, pad_mask, seg_mask = self.prepare_batch(query, document)
-        
-        out = self._bert(input_ids=tok_seq, attention_mask=pad_mask, token_type_ids=seg_mask)
-        cls_output = out[0][:,0,:]
+    def forward(self, query: torch.Tensor, document: torch.Tensor, use_adversary: bool = True) -> torch.Tensor:
+        cls_output = self.encode_cls(query, document)
         
         scores = self._output_projection_layer(cls_output)
         lprobs = torch.nn.LogSoftmax(dim=-1)(scores)
         rels = lprobs[:,0]
+
+        if not use_adversary:
+            return {"rels" : rels, "logprobs": lprobs}
         
-        adversary_scores = self.adversary_net.forward(ReverseLayerF.apply(cls_output, self.adv_rev_factor))
-        adversary_lprobs = torch.nn.LogSoftmax(dim=-1)(adversary_scores)
+        adversary_lprobs = self.adversary_forward(cls_output)
         
         return {"rels" : rels, "logprobs": lprobs, "adv_logprobs": adversary_lprobs}
 
-    def prepare_batch(self, query: torch.Tensor, document: torch.Tensor) -> torch.Tensor:
-        
-        bsz = document.size(0)
+    def encode_cls(self, query: torch.Tensor, document: torch.Tensor) -> torch.Tensor:
+        tok_seq, pad_mask, seg_mask = self.prepare_batch(query, document)
         
-        tok_seq = torch.full((bsz, self.max_input_length), 0, dtype=int).cuda()
-        seg_mask = torch.full((bsz, self.max_input_length), 0, dtype=int).cuda()
-        seg_1_value = 0
-        seg_2_value = 1
+        out = self._bert(input_ids=tok_seq, attention_mask=pad_mask, token_type_ids=seg_mask)
+        return out[0][:,0,:]
+
+    def adversary_forward(self, cls_output: torch.Tensor) -> torch.Tensor:
+        adversary_scores = self.adversary_net.forward(ReverseLayerF.apply(cls_output, self.adv_rev_factor))
+        return torch.nn.LogSoftmax(dim=-1)(adversary_scores)
+
+    #
+    # scores the positive and negative documents of a training batch in one forward pass (stacked into a 2B batch),
+    # returns the output dicts of the positive and the negative documents
+    #
+    def forward_paired(self, query: torch.Tensor, doc_pos: torch.Tensor, doc_neg: torch.Tensor, 
+                       use_adversary: bool = True) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+        bsz = query.size(0)
+        _doc_length = max(doc_pos.size(1), doc_neg.size(1))
+        documents = torch.cat([F.pad(doc_pos, (0, _doc_length - doc_pos.size(1))),
+                               F.pad(doc_neg, (0, _doc_length - doc_neg.size(1)))], dim=0)
         
-        tok_seq[:, 0] = torch.full((bsz, 1), self.cls_token_id, dtype=int)[:, 0]
-        seg_mask[:, 0] = torch.full((bsz, 1), seg_1_value, dtype=int)[:, 0]
+        output_dict = self.forward(torch.cat([query, query], dim=0), documents, use_adversary=use_adversary)
+
+        output_pos_dict = {_key: _value[:bsz] for _key, _value in output_dict.items()}
+        output_neg_dict = {_key: _value[bsz:] for _key, _value in output_dict.items()}
+        return output_pos_dict, output_neg_dict
+
+    def prepare_batch(self, query: torch.Tensor, document: torch.Tensor) -> torch.Tensor:
+        return prepare_bert_input(query, document, self.cls_token_id, self.sep_token_id, self.max_input_length,
+                                  self.dynamic_input_length, self.input_length_multiple)
+
+
+#
+# <probe_count> independent adversary heads of the same architecture (Linear-Tanh-Linear like adversary_net, or a 
+# linear probe for hidden_size 0), each initialized with its own seed and computed as one batched operation
+#
+class GroupedAdversaryProbes(torch.nn.Module):
+    def __init__(self, input_size: int, hidden_size: int, seeds: List[int]):
+        super(GroupedAdversaryProbes, self).__init__()
+        self.hidden_size = hidden_size
+        self.probe_count = len(seeds)
+
+        _first_layers = []
+        _second_layers = []
+        for _seed in seeds:
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(_seed)
+                if hidden_size > 0:
+                    _first_layers.append(torch.nn.Linear(input_size, hidden_size, bias=True))
+                    _second_layers.append(torch.nn.Linear(hidden_size, 2, bias=True))
+                else:
+                    _second_layers.append(torch.nn.Linear(input_size, 2, bias=True))
         
-        for batch_i in range(bsz):
-            # query
-            _offset = 1
-            _vec = query[batch_i]
-            _length = len(_vec[_vec != 0])
-            tok_seq[batch_i, _offset:_length+_offset] = query[batch_i, :_length]
-            seg_mask[batch_i, _offset:_length+_offset] = torch.full((_length, 1), seg_1_value, dtype=int)[:, 0]
-            _offset += _length
-            
-            tok_seq[batch_i, _offset:_offset+1] = self.sep_token_id
-            seg_mask[batch_i, _offset:_offset+1] = seg_1_value
-            _offset += 1
-            
-            # document
-            ## we assume that length of query (+2) never exceeds <max_input_length>
-            ## therefore we only truncate the document
-            ## in extreme cases this can hurt
-            _vec = document[batch_i]
-            _length = len(_vec[_vec != 0])
-            _fill_until = _length + _offset
-            if _fill_until >= self.max_input_length:
-                _fill_until = self.max_input_length - 1 # leaving space for the last <sep> 
-                _length = _fill_until - _offset
-            tok_seq[batch_i, _offset:_fill_until] = document[batch_i, :_length]
-            seg_mask[batch_i, _offset:_fill_until] = torch.full((_length, 1), seg_2_value, dtype=int)[:, 0]
-            _offset += _length
-            
-            tok_seq[batch_i, _offset:_offset+1] = self.sep_token_id
-            seg_mask[batch_i, _offset:_offset+1] = seg_2_value
-            _offset += 1
-            
-        pad_mask = util.get_text_field_mask({"tokens":tok_seq}).cuda()
+        if hidden_size > 0:
+            self.weight_1 = torch.nn.Parameter(torch.stack([_layer.weight.data.t() for _layer in _first_layers]))
+            self.bias_1 = torch.nn.Parameter(torch.stack([_layer.bias.data for _layer in _first_layers]).unsqueeze(1))
+        self.weight_2 = torch.nn.Parameter(torch.stack([_layer.weight.data.t() for _layer in _second_layers]))
+        self.bias_2 = torch.nn.Parameter(torch.stack([_layer.bias.data for _layer in _second_layers]).unsqueeze(1))
+
+    # (batch, input_size) -> log-probabilities (probe_count, batch, 2)
+    def forward(self, features: torch.Tensor) -> torch.Tensor:
+        x = features.unsqueeze(0).expand(self.probe_count, -1, -1)
+        if self.hidden_size > 0:
+            x = torch.tanh(torch.baddbmm(self.bias_1, x, self.weight_1))
+        return F.log_softmax(torch.baddbmm(self.bias_2, x, self.weight_2), dim=-1)
+
+
+#
+# the constructor arguments of an AdvBert with the same architecture (without the weights), to re-create the model
+# in another process: AdvBert(bert=BertModel(bert_config), **<the other arguments>)
+#
+def get_model_args(model: AdvBert) -> Dict[str, any]:
+    return {"bert_config": model._bert.config, "adv_rev_factor": model.adv_rev_factor,
+            "cls_token_id": model.cls_token_id, "sep_token_id": model.sep_token_id,
+            "dynamic_input_length": model.dynamic_input_length, "input_length_multiple": model.input_length_multiple}
+
+def create_model_from_args(model_args: Dict[str, any]) -> AdvBert:
+    _model_args = dict(model_args)
+    return AdvBert(bert=BertModel(_model_args.pop("bert_config")), **_model_args)
+
+#
+# copy of the model for inference on the cpu, optionally with dynamic int8 quantization of the BERT linear layers
+#
+def get_cpu_inference_model(model: AdvBert, quantize_int8: bool = False) -> AdvBert:
+    _model = copy.deepcopy(model).cpu()
+    _model.eval()
+    if quantize_int8:
+        _model._bert = torch.quantization.quantize_dynamic(_model._bert, {torch.nn.Linear}, dtype=torch.qint8)
+    return _model
+
+
+#
+# relevance scoring path of AdvBert (BERT + output projection, without the adversary) on prepared BERT inputs,
+# used to export the ranker for serving
+#
+class AdvBertRankerGraph(torch.nn.Module):
+    def __init__(self, model: AdvBert):
+        super(AdvBertRankerGraph, self).__init__()
+        self._bert = model._bert
+        self._output_projection_layer = model._output_projection_layer
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor) -> torch.Tensor:
+        out = self._bert(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids, 
+                         return_dict=False)
+        cls_output = out[0][:,0,:]
         
-        return tok_seq, pad_mask, seg_mask
+        scores = self._output_projection_layer(cls_output)
+        rels = F.log_softmax(scores, dim=-1)[:,0]
+        return rels
+
+
+#
+# BERT encoder as defined in the config, either pre-trained or random
+#
+def get_bert_model(config) -> BertModel:
+    if config["transformers_pretrained_model_id"] == "random":
+        _bert_config_standard = AutoConfig.for_model('bert')
+        bert_config = BertConfig(vocab_size = _bert_config_standard.vocab_size,
+                                 hidden_size = config["bert_hidden_size"], #?
+                                 num_hidden_layers = config["bert_num_layers"],
+                                 num_attention_heads = config["bert_num_heads"],
+                                 intermediate_size = config["bert_intermediate_size"],
+                                 hidden_dropout_prob = config["bert_dropout"], #!
+                                 attention_probs_dropout_prob = config["bert_dropout"])
+        return BertModel(bert_config)
+    else:
+        return BertModel.from_pretrained(config["transformers_pretrained_model_id"], cache_dir="cache")
+
+#
+# activation checkpointing of every n-th BERT layer: the activations inside these layers are not kept for the 
+# backward pass but recomputed, which trades compute for memory (larger batches / longer inputs). 
+# the class of the layers is changed to CheckpointedBertLayer, so that the parameter names (state_dict) stay unchanged 
+# and copies of the model (deepcopy, quantize_dynamic, pickling) run their own layers
+#
+class CheckpointedBertLayer(BertLayer):
+    def forward(self, *args, **kwargs):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super(CheckpointedBertLayer, self).forward, *args, use_reentrant=False, **kwargs)
+        return super(CheckpointedBertLayer, self).forward(*args, **kwargs)
+
+def enable_activation_checkpointing(bert: BertModel, every_n_layers: int = 1) -> List[int]:
+    _checkpointed_layers = []
+    for _layer_i, _layer in enumerate(bert.encoder.layer):
+        if _layer_i % every_n_layers == 0:
+            _layer.__class__ = CheckpointedBertLayer
+            _checkpointed_layers.append(_layer_i)
+    return _checkpointed_layers
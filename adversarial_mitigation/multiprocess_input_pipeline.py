@@ -1,10 +1,15 @@
 import re
 import pdb
+import time
+import random
+import numpy as np
 from gensim import utils
 
+import torch
 import torch.multiprocessing as mp
 
 from allennlp.data.iterators import BucketIterator
+from allennlp.data.dataset import Batch
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.modules.text_field_embedders import BasicTextFieldEmbedder
 from allennlp.data.tokenizers.word_splitter import JustSpacesWordSplitter
@@ -17,6 +22,7 @@ from typing import Dict, Tuple, List
 from transformers import BertTokenizer, BartTokenizer
 
 from fairness_measurement.document_neutrality import DocumentNeutrality
+from utils import parse_reference_set
 
 #
 # Multiprocess input pipeline
@@ -31,14 +37,209 @@ from fairness_measurement.document_neutrality import DocumentNeutrality
 mp.get_logger().setLevel(logging.WARNING)  # ignore useless process start console logs
 mp.set_sharing_strategy("file_system") # VERY MUCH needed for linux !! makes everything MUCH faster -> from 10 to 30+ batches/s
 
+#
+# shared-memory batch transport
+# -------------------------------
+#
+# a fixed pool of preallocated shared-memory slots (sized for the maximum batch shape), used instead of the mp.Queue
+# when the config sets batch_transport: "shared_memory"
+#
+# - the loader processes copy token ids and labels of a batch into a free slot and pass only the slot index (and the
+#   ids of the batch, as they are)
+# - the consumer reads the batch from the slot (no pickling, no new shared-memory files) and recycles the slot when it 
+#   fetches the next batch
+# - the token ids are stored as int32 (half the shared memory of int64) and read as torch.long
+# - a batch that does not fit into the slots fails the loader, which signals the failure to the consumer
+#
+class SharedMemoryBatchRing():
+    def __init__(self, ctx, slot_count: int, max_batch_size: int, token_fields: Dict[str, int], 
+                 label_fields: List[str], id_fields: List[str] = []):
+        self.slot_count = slot_count
+        self.max_batch_size = max_batch_size
+        self.token_fields = token_fields
+        self.label_fields = label_fields
+        self.id_fields = id_fields
+
+        self._slots = {}
+        for _field, _max_length in self.token_fields.items():
+            self._slots[_field] = torch.zeros((slot_count, max_batch_size, _max_length), dtype=torch.int32).share_memory_()
+        for _field in self.label_fields:
+            self._slots[_field] = torch.zeros((slot_count, max_batch_size), dtype=torch.long).share_memory_()
+        # per slot: batch size, followed by the (padded) length of every token field
+        self._shapes = torch.zeros((slot_count, 1 + len(self.token_fields)), dtype=torch.long).share_memory_()
+
+        self._free_slots = ctx.Queue(slot_count)
+        self._ready_slots = ctx.Queue()
+        for _slot in range(slot_count):
+            self._free_slots.put(_slot)
+
+        self._slot_in_use = None # consumer side only
+
+    #
+    # producer side
+    #
+    def put(self, batch):
+        if batch is None:
+            self._ready_slots.put(-1) # end of queue
+            return
+
+        try:
+            _batch_size = len(batch[self.label_fields[0]])
+            if _batch_size > self.max_batch_size:
+                raise Exception("Batch of size %d does not fit into the shared-memory slots (max. %d)" % 
+                                (_batch_size, self.max_batch_size))
+            for _field, _max_length in self.token_fields.items():
+                if batch[_field].shape[1] > _max_length:
+                    raise Exception("Batch with %d %s does not fit into the shared-memory slots (max. %d)" % 
+                                    (batch[_field].shape[1], _field, _max_length))
+        except BaseException as e:
+            self._ready_slots.put(-2) # failed loader
+            raise e
+
+        _slot = self._free_slots.get()
+        self._shapes[_slot, 0] = _batch_size
+        for _field_i, _field in enumerate(self.token_fields):
+            _length = batch[_field].shape[1]
+            self._slots[_field][_slot, :_batch_size, :_length].copy_(batch[_field])
+            self._shapes[_slot, _field_i + 1] = _length
+        for _field in self.label_fields:
+            self._slots[_field][_slot, :_batch_size].copy_(batch[_field])
+
+        self._ready_slots.put((_slot, {_field: batch[_field] for _field in self.id_fields}))
+
+    def close(self):
+        self._ready_slots.close()
+
+    #
+    # consumer side, the batch returned by the previous get() is not valid anymore after the next call
+    #
+    def get(self):
+        if self._slot_in_use is not None:
+            self._free_slots.put(self._slot_in_use)
+            self._slot_in_use = None
+
+        _ready = self._ready_slots.get()
+        if _ready == -1:
+            return None
+        if _ready == -2:
+            raise Exception("A loader process failed to transport its batch, see its error output")
+        _slot, _ids = _ready
+        self._slot_in_use = _slot
+
+        _shape = self._shapes[_slot].tolist()
+        _batch_size = _shape[0]
+        batch = {}
+        for _field_i, _field in enumerate(self.token_fields):
+            batch[_field] = self._slots[_field][_slot, :_batch_size, :_shape[_field_i + 1]].long()
+        for _field in self.label_fields:
+            batch[_field] = self._slots[_field][_slot, :_batch_size]
+        batch.update(_ids)
+        return batch
+
+    def qsize(self):
+        return self._ready_slots.qsize()
+
+#
+# loader throughput and starvation counters
+# -------------------------------
+#
+# - every loader process updates its own row of a shared-memory tensor (lines parsed, time spent reading & tokenizing,
+#   batches produced, time blocked on a full queue, time since start, hits and lookups of the tokenization caches)
+# - the consumer (trainer / inference loop) fetches the batches via get() to track the time it waits on the queue
+#
+class LoaderStats():
+    FIELDS = ["lines", "tokenization_time", "batches", "queue_blocked_time", "elapsed_time",
+              "query_cache_hits", "query_cache_lookups", "doc_cache_hits", "doc_cache_lookups"]
+
+    def __init__(self, worker_count: int):
+        self.worker_count = worker_count
+        self._values = torch.zeros((worker_count, len(self.FIELDS)), dtype=torch.float64).share_memory_()
+        
+        self.consumer_start_time = time.perf_counter() # consumer side only
+        self.consumer_wait_time = 0.0
+
+    #
+    # loader process side
+    #
+    def add(self, worker: int, field: str, value: float):
+        self._values[worker, self.FIELDS.index(field)] += value
+
+    def set(self, worker: int, field: str, value: float):
+        self._values[worker, self.FIELDS.index(field)] = value
+
+    def timed_instances(self, worker: int, instances):
+        _start_time = time.perf_counter()
+        _instances = iter(instances)
+        while (True):
+            _read_start_time = time.perf_counter()
+            try:
+                _instance = next(_instances)
+            except StopIteration:
+                break
+            _now = time.perf_counter()
+            self.add(worker, "tokenization_time", _now - _read_start_time)
+            self.add(worker, "lines", 1)
+            self.set(worker, "elapsed_time", _now - _start_time)
+            yield _instance
+
+    def timed_put(self, worker: int, queue, batch):
+        _start_time = time.perf_counter()
+        queue.put(batch)
+        self.add(worker, "queue_blocked_time", time.perf_counter() - _start_time)
+        if batch is not None:
+            self.add(worker, "batches", 1)
+
+    #
+    # consumer side
+    #
+    def timed_get(self, queue):
+        _start_time = time.perf_counter()
+        batch = queue.get()
+        self.consumer_wait_time += time.perf_counter() - _start_time
+        return batch
+
+    def summary(self) -> Dict[str, any]:
+        _workers = []
+        for _worker_values in self._values.tolist():
+            _worker = dict(zip(self.FIELDS, _worker_values))
+            _elapsed = _worker["elapsed_time"]
+            _worker["lines_per_sec"] = _worker["lines"] / _elapsed if _elapsed > 0 else 0.0
+            _workers.append(_worker)
+
+        _consumer_elapsed = time.perf_counter() - self.consumer_start_time
+        return {"lines_per_sec": sum([x["lines_per_sec"] for x in _workers]),
+                "tokenization_time": sum([x["tokenization_time"] for x in _workers]),
+                "batches": sum([x["batches"] for x in _workers]),
+                "queue_blocked_time": sum([x["queue_blocked_time"] for x in _workers]),
+                "consumer_wait_time": self.consumer_wait_time,
+                "consumer_wait_fraction": self.consumer_wait_time / _consumer_elapsed if _consumer_elapsed > 0 else 0.0,
+                "query_cache_hit_rate": self._hit_rate(_workers, "query_cache"),
+                "doc_cache_hit_rate": self._hit_rate(_workers, "doc_cache"),
+                "workers": _workers}
+
+    def _hit_rate(self, workers, cache: str) -> float:
+        _lookups = sum([x[cache + "_lookups"] for x in workers])
+        return sum([x[cache + "_hits"] for x in workers]) / _lookups if _lookups > 0 else 0.0
+
+    def write_tensorboard(self, tb_writer, prefix: str, step: int):
+        for _name, _value in self.summary().items():
+            if _name != "workers":
+                tb_writer.add_scalar("%s/%s" % (prefix, _name), _value, step)
+
 #
 # process & queue starter, returns a queue which gets the batches put into ready to go into the model.forward pass
 #
-def get_multiprocess_batch_queue(name_prefix: str, target_function, files, conf, _logger, queue_size=100) -> Tuple[mp.Queue, List[mp.Process], mp.Event]:
+def get_multiprocess_batch_queue(name_prefix: str, target_function, files, conf, _logger, queue_size=100) -> Tuple[mp.Queue, List[mp.Process], mp.Event, LoaderStats]:
     ctx = mp.get_context('spawn') # also set so that windows & linux behave the same 
-    _queue = ctx.Queue(queue_size)
+    if conf.get("batch_transport", "queue") == "shared_memory":
+        # the batches in flight: a few per loader plus the one the consumer reads, instead of the full queue size
+        _slot_count = min(queue_size, len(files) * int(conf.get("shared_memory_slots_per_loader", 4)) + 1)
+        _queue = get_shared_memory_batch_ring(ctx, target_function, conf, _slot_count)
+    else:
+        _queue = ctx.Queue(queue_size)
     _processes = []
     _finish_notification = ctx.Event()
+    _stats = LoaderStats(len(files))
 
     if len(files) == 0:
         _logger.error("No files for multiprocess loading specified, for: " + name_prefix)
@@ -49,11 +250,64 @@ def get_multiprocess_batch_queue(name_prefix: str, target_function, files, conf,
     for proc_number, file in enumerate(files):
         process = ctx.Process(name=name_prefix + "-" + str(proc_number),
                              target=target_function,
-                             args=(proc_number, conf, _queue, _finish_notification, file))
+                             args=(proc_number, conf, _queue, _finish_notification, file, _stats))
         process.start()
         _processes.append(process)
-    return _queue, _processes, _finish_notification
+    return _queue, _processes, _finish_notification, _stats
+
+
+#
+# token-budget batch generator (used instead of the BucketIterator when the config sets batching: "token_budget")
+#   - reads <shuffle_window> instances, sorts them by length and packs them into batches, so that the padded number 
+#     of (query+doc) tokens of a batch stays below <max_tokens>
+#   - with shuffle, the order of the batches inside a window is shuffled
+#
+def token_budget_batches(instances, max_tokens: int, query_field: str, doc_fields: List[str], shuffle_window: int, 
+                         max_batch_size: int, shuffle=True):
+    _vocab = Vocabulary()
+    _window = []
+    for _instance in instances:
+        _window.append(_instance)
+        if len(_window) == shuffle_window:
+            yield from _pack_token_budget_window(_window, _vocab, max_tokens, query_field, doc_fields, 
+                                                 max_batch_size, shuffle)
+            _window = []
+    if len(_window) > 0:
+        yield from _pack_token_budget_window(_window, _vocab, max_tokens, query_field, doc_fields, 
+                                             max_batch_size, shuffle)
+
+def _pack_token_budget_window(window, vocab, max_tokens, query_field, doc_fields, max_batch_size, shuffle):
+    _query_lengths = np.array([_instance.fields[query_field].array.shape[0] for _instance in window])
+    _doc_lengths = np.array([max([_instance.fields[_field].array.shape[0] for _field in doc_fields]) 
+                             for _instance in window])
+    _order = np.argsort(_query_lengths + _doc_lengths, kind="stable")
+
+    _batches = []
+    _batch = []
+    _max_query_length = 0
+    _max_doc_length = 0
+    for _i in _order:
+        _new_max_query_length = max(_max_query_length, _query_lengths[_i])
+        _new_max_doc_length = max(_max_doc_length, _doc_lengths[_i])
+        _padded_tokens = (len(_batch) + 1) * (_new_max_query_length + _new_max_doc_length)
+        if len(_batch) > 0 and (_padded_tokens > max_tokens or len(_batch) == max_batch_size):
+            _batches.append(_batch)
+            _batch = []
+            _new_max_query_length = _query_lengths[_i]
+            _new_max_doc_length = _doc_lengths[_i]
+        _batch.append(window[_i])
+        _max_query_length = _new_max_query_length
+        _max_doc_length = _new_max_doc_length
+    if len(_batch) > 0:
+        _batches.append(_batch)
 
+    if shuffle:
+        random.shuffle(_batches)
+
+    for _batch_instances in _batches:
+        _batch = Batch(_batch_instances)
+        _batch.index_instances(vocab)
+        yield _batch.as_tensor_dict(_batch.get_padding_lengths())
 
 #
 # training instance generator
@@ -61,7 +315,7 @@ def get_multiprocess_batch_queue(name_prefix: str, target_function, files, conf,
 #   - everything is thread local
 #
 def multiprocess_training_loader(process_number: int, _config, _queue: mp.Queue, _wait_for_exit: mp.Event, 
-                                 _local_file):
+                                 _local_file, _stats: LoaderStats):
 
     _transformers_tokenizer = BertTokenizer.from_pretrained(_config["transformers_tokenizer_model_id"])
     _doc_neutrality = DocumentNeutrality(representative_words_path=_config["neutrality_representative_words_path"],
@@ -74,11 +328,20 @@ def multiprocess_training_loader(process_number: int, _config, _queue: mp.Queue,
                                                                         max_doc_length = _config["max_doc_length"],
                                                                         max_query_length = _config["max_query_length"],
                                                                         doc_neutrality=_doc_neutrality)
-    _iterator = BucketIterator(batch_size=int(_config["batch_size_train"]),
-                               sorting_keys=[("doc_pos_tokens", "dimension_0"), ("doc_neg_tokens", "dimension_0")])
+    if _config.get("batching", "bucket") == "token_budget":
+        _batches = token_budget_batches(_stats.timed_instances(process_number, _triple_loader.read(_local_file)),
+                                        max_tokens=int(_config["batch_token_budget_train"]),
+                                        query_field="query_tokens", doc_fields=["doc_pos_tokens", "doc_neg_tokens"],
+                                        shuffle_window=int(_config["batch_token_budget_shuffle_window"]),
+                                        max_batch_size=int(_config["batch_token_budget_max_batch_size"]),
+                                        shuffle=True)
+    else:
+        _iterator = BucketIterator(batch_size=int(_config["batch_size_train"]),
+                                   sorting_keys=[("doc_pos_tokens", "dimension_0"), ("doc_neg_tokens", "dimension_0")])
+        _batches = _iterator(_stats.timed_instances(process_number, _triple_loader.read(_local_file)), num_epochs=1)
     
-    for training_batch in _iterator(_triple_loader.read(_local_file), num_epochs=1):
-        _queue.put(training_batch)  # this moves the tensors in to shared memory
+    for training_batch in _batches:
+        _stats.timed_put(process_number, _queue, training_batch)  # this moves the tensors in to shared memory
     _queue.put(None) # end of queue
 
     _queue.close()  # indicate this local thread is done
@@ -90,30 +353,81 @@ def multiprocess_training_loader(process_number: int, _config, _queue: mp.Queue,
 #   - everything is defined thread local
 #
 def multiprocess_validation_loader(process_number: int, _config, _queue: mp.Queue, _wait_for_exit: mp.Event, 
-                                   _local_file):
+                                   _local_file, _stats: LoaderStats):
 
     _transformers_tokenizer = BertTokenizer.from_pretrained(_config["transformers_tokenizer_model_id"])
     _doc_neutrality = DocumentNeutrality(representative_words_path=_config["neutrality_representative_words_path"],
                                          threshold=_config["neutrality_threshold"],
                                          groups_portion={'f':0.5, 'm':0.5})
 
+    # only the tuples inside the re-ranking cutoff of the candidate set, (candidate set path, cutoff) set by predict_relevance
+    _tuple_filter = None
+    if _config.get("evaluation_candidate_filter") is not None:
+        _candidate_set_path, _cutoff = _config["evaluation_candidate_filter"]
+        _reference_set_rank, _ = parse_reference_set(_candidate_set_path, _cutoff)
+        _tuple_filter = {_qid: set(_docids.keys()) for _qid, _docids in _reference_set_rank.items()}
+
     _tuple_loader  = IrTupleTransformersNeutralityScoresDatasetReader(lazy=True,
                                                                       transformers_tokenizer=_transformers_tokenizer,
                                                                       add_special_tokens=False,
                                                                       max_doc_length=_config["max_doc_length"],
                                                                       max_query_length=_config["max_query_length"],
-                                                                      doc_neutrality=_doc_neutrality)
-    _iterator = BucketIterator(batch_size=int(_config["batch_size_train"]),
-                               sorting_keys=[("doc_tokens", "dimension_0"), ("query_tokens", "dimension_0")])
+                                                                      doc_neutrality=_doc_neutrality,
+                                                                      cache_size=int(_config.get("tokenization_cache_size", 0)),
+                                                                      tuple_filter=_tuple_filter,
+                                                                      # (index, count) set by query-parallel inference
+                                                                      query_partition=_config.get("evaluation_query_partition"))
+    if _config.get("batching", "bucket") == "token_budget":
+        _batches = token_budget_batches(_stats.timed_instances(process_number, _tuple_loader.read(_local_file)),
+                                        max_tokens=int(_config["batch_token_budget_eval"]),
+                                        query_field="query_tokens", doc_fields=["doc_tokens"],
+                                        shuffle_window=int(_config["batch_token_budget_shuffle_window"]),
+                                        max_batch_size=int(_config["batch_token_budget_max_batch_size"]),
+                                        shuffle=False)
+    else:
+        _iterator = BucketIterator(batch_size=int(_config["batch_size_eval"]),
+                                   sorting_keys=[("doc_tokens", "dimension_0"), ("query_tokens", "dimension_0")])
+        _batches = _iterator(_stats.timed_instances(process_number, _tuple_loader.read(_local_file)), num_epochs=1)
     
-    for _batch in _iterator(_tuple_loader.read(_local_file), num_epochs=1):
+    for _batch in _batches:
         if _batch is None:
             print ('a batch is null!!!')
-        _queue.put(_batch)  # this moves the tensors in to shared memory
+        _stats.timed_put(process_number, _queue, _batch)  # this moves the tensors in to shared memory
+
+    # before the end of queue, so that the consumer sees the final counts
+    for _cache_name, _cache in [("query_cache", _tuple_loader.query_cache), ("doc_cache", _tuple_loader.doc_cache)]:
+        if _cache is not None:
+            _stats.set(process_number, _cache_name + "_hits", _cache.hits)
+            _stats.set(process_number, _cache_name + "_lookups", _cache.hits + _cache.misses)
     _queue.put(None) # end of queue
 
     _queue.close()  # indicate this local thread is done
     _wait_for_exit.wait()  # keep this process alive until all the shared memory is used and not needed anymore
 
+#
+# slot layout of the shared-memory transport for each loader. the token sequences are at most as long as the 
+# tokenizer limit (the readers truncate the words to max_query_length and max_doc_length, but a word can be several 
+# tokens), the config can set shorter slots
+#
+def get_shared_memory_batch_ring(ctx, target_function, conf, slot_count) -> SharedMemoryBatchRing:
+    _tokenizer_limit = BertTokenizer.from_pretrained(conf["transformers_tokenizer_model_id"]).model_max_length
+    _max_query_tokens = int(conf.get("shared_memory_max_query_tokens") or _tokenizer_limit)
+    _max_doc_tokens = int(conf.get("shared_memory_max_doc_tokens") or _tokenizer_limit)
+    _token_budget = conf.get("batching", "bucket") == "token_budget"
 
-
+    if target_function == multiprocess_training_loader:
+        _max_batch_size = conf["batch_token_budget_max_batch_size"] if _token_budget else conf["batch_size_train"]
+        return SharedMemoryBatchRing(ctx, slot_count, max_batch_size=int(_max_batch_size),
+                                     token_fields={"query_tokens": _max_query_tokens,
+                                                   "doc_pos_tokens": _max_doc_tokens,
+                                                   "doc_neg_tokens": _max_doc_tokens},
+                                     label_fields=["protected_label_pos", "protected_label_neg"])
+    elif target_function == multiprocess_validation_loader:
+        _max_batch_size = conf["batch_token_budget_max_batch_size"] if _token_budget else conf["batch_size_eval"]
+        return SharedMemoryBatchRing(ctx, slot_count, max_batch_size=int(_max_batch_size),
+                                     token_fields={"query_tokens": _max_query_tokens,
+                                                   "doc_tokens": _max_doc_tokens},
+                                     label_fields=["protected_label"],
+                                     id_fields=["query_id", "doc_id"])
+    else:
+        raise Exception("No shared-memory batch layout defined for %s" % target_function.__name__)
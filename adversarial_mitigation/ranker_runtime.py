@@ -0,0 +1,55 @@
+#
+# cpu runtime of an exported AdvBert ranker (see export_ranker.py)
+# -------------------------------
+#
+# scores batches of (query ids, doc ids) with the exported TorchScript (.pt) or ONNX (.onnx) graph,
+# only depends on torch (and onnxruntime for .onnx), not on allennlp or the training code
+#
+# usage:
+#   runtime = RankerRuntime("ranker.onnx")
+#   rels = runtime.score(query_ids, doc_ids)  # 0-padded (batch, length) token ids, without special tokens
+
+from typing import Union
+
+import numpy as np
+import torch
+
+from bert_input import prepare_bert_input
+
+
+class RankerRuntime():
+    def __init__(self, model_path: str, cls_token_id: int = 101, sep_token_id: int = 102, max_input_length: int = 512,
+                 input_length_multiple: int = 8, intra_op_threads: int = None):
+        self.model_path = model_path
+        self.cls_token_id = cls_token_id
+        self.sep_token_id = sep_token_id
+        self.max_input_length = max_input_length
+        self.input_length_multiple = input_length_multiple
+
+        if model_path.endswith(".onnx"):
+            import onnxruntime
+            _options = onnxruntime.SessionOptions()
+            if intra_op_threads is not None:
+                _options.intra_op_num_threads = intra_op_threads
+            self._session = onnxruntime.InferenceSession(model_path, _options, providers=["CPUExecutionProvider"])
+            self._module = None
+        else:
+            if intra_op_threads is not None:
+                torch.set_num_threads(intra_op_threads)
+            self._session = None
+            self._module = torch.jit.load(model_path, map_location="cpu")
+            self._module.eval()
+
+    def score(self, query: Union[np.ndarray, torch.Tensor], document: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+        tok_seq, pad_mask, seg_mask = prepare_bert_input(torch.as_tensor(query), torch.as_tensor(document),
+                                                         self.cls_token_id, self.sep_token_id, self.max_input_length,
+                                                         dynamic_input_length=True,
+                                                         input_length_multiple=self.input_length_multiple)
+        if self._session is not None:
+            rels = self._session.run(["rels"], {"input_ids": tok_seq.numpy(),
+                                                "attention_mask": pad_mask.numpy(),
+                                                "token_type_ids": seg_mask.numpy()})[0]
+        else:
+            with torch.inference_mode():
+                rels = self._module(tok_seq, pad_mask, seg_mask).numpy()
+        return rels
@@ -1,9 +1,10 @@
 import yaml
 from timeit import default_timer
-from typing import Dict
-from datetime import datetime
+from typing import Dict, List
+from datetime import datetime, timedelta
 import os
 import logging
+import resource
 import argparse
 import shutil
 import pickle
@@ -11,6 +12,7 @@ import pdb
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
 
@@ -71,6 +73,10 @@ def get_parser():
                         help='use CUDA')
     parser.add_argument('--debug', action='store_true',
                         help='debug')
+    parser.add_argument('--distributed', action='store_true',
+                        help='data-parallel training on the cpu with torch.distributed (gloo), launch the ranks with: torchrun --nproc_per_node N main.py ...')
+    parser.add_argument('--distributed-timeout', action='store', dest='distributed_timeout', type=int, default=180,
+                        help='minutes the ranks wait for each other (e.g. while rank 0 validates)', required=False)
     
     # custom settings
     parser.add_argument('--custom-filter-gendered-tokens', action='store_true', dest='custom_filter_gendered_tokens',
@@ -87,12 +93,12 @@ def get_parser():
     
     return parser
 
-def get_logger_to_file(run_folder,name):
+def get_logger_to_file(run_folder,name,log_file_name='log.txt'):
     logger = logging.getLogger(name)
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
     logger.setLevel(logging.INFO)
 
-    log_filepath = os.path.join(run_folder, 'log.txt')
+    log_filepath = os.path.join(run_folder, log_file_name)
     file_hdlr = logging.FileHandler(log_filepath)
     file_hdlr.setFormatter(formatter)
     file_hdlr.setLevel(logging.INFO)
@@ -105,6 +111,15 @@ def get_logger_to_file(run_folder,name):
 
     return logger
 
+def get_logger_to_console(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if len(logger.handlers) == 0:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        logger.addHandler(console_handler)
+    return logger
+
 def prepare_experiment_folder(base_path, run_name, add_timestamp=True):
     if add_timestamp:
         time_stamp = datetime.now().strftime('%Y-%m-%d_%H%M%S.%f')[:-4]
@@ -171,6 +186,71 @@ def prepare_experiment(args):
             
     return run_folder, config
 
+#
+# peak memory of the training process in MB: allocated cuda memory, or the peak resident set size on the cpu
+#
+def get_peak_memory_mb(cuda_device):
+    if cuda_device != -1:
+        return torch.cuda.max_memory_allocated(cuda_device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 # linux reports KB
+
+#
+# data-parallel training helpers (torch.distributed, gloo backend)
+#   - the ranks are launched by torchrun, which sets the RANK / WORLD_SIZE / MASTER_ADDR environment variables
+#
+def init_distributed(timeout_minutes=180):
+    dist.init_process_group(backend="gloo", timeout=timedelta(minutes=timeout_minutes))
+    return dist.get_rank(), dist.get_world_size()
+
+def broadcast_object(obj, src=0):
+    _objects = [obj]
+    dist.broadcast_object_list(_objects, src=src)
+    return _objects[0]
+
+def broadcast_model_state(model, src=0):
+    for _tensor in model.state_dict().values():
+        dist.broadcast(_tensor, src=src)
+
+def distributed_any(flag: bool) -> bool:
+    _flag = torch.tensor([int(flag)])
+    dist.all_reduce(_flag, op=dist.ReduceOp.MAX)
+    return bool(_flag.item())
+
+#
+# averages the gradients over the ranks, the gradients are flattened into buckets of <bucket_size> elements
+# to keep the number of all-reduce calls small
+#
+def all_reduce_gradients(parameters, world_size, bucket_size=2**22):
+    _bucket = []
+    _bucket_numel = 0
+    for _param in parameters:
+        if _param.grad is None:
+            continue
+        _bucket.append(_param.grad)
+        _bucket_numel += _param.grad.numel()
+        if _bucket_numel >= bucket_size:
+            _all_reduce_bucket(_bucket, world_size)
+            _bucket = []
+            _bucket_numel = 0
+    if len(_bucket) > 0:
+        _all_reduce_bucket(_bucket, world_size)
+
+def _all_reduce_bucket(grads, world_size):
+    _flat = torch._utils._flatten_dense_tensors(grads)
+    dist.all_reduce(_flat)
+    _flat /= world_size
+    for _grad, _reduced in zip(grads, torch._utils._unflatten_dense_tensors(_flat, grads)):
+        _grad.copy_(_reduced)
+
+#
+# evaluation_reranking_cutoff is a single cutoff or a list of cutoffs, the first one is the main cutoff
+#
+def get_reranking_cutoffs(config) -> List[int]:
+    _cutoffs = config["evaluation_reranking_cutoff"]
+    if isinstance(_cutoffs, (list, tuple)):
+        return [int(_cutoff) for _cutoff in _cutoffs]
+    return [int(_cutoffs)]
+
 def parse_reference_set(file_path, to_N):
     reference_set_rank = {} # dict[qid][did] -> rank
     reference_set_tuple = {} # dict[qid] -> sorted list of (did, score)
@@ -214,7 +294,9 @@ def model_save(filepath, model, best_result_info):
 
 def model_load(filepath, _GPU_n = None):
     with open(filepath, 'rb') as f:
-        if _GPU_n != None:
+        if _GPU_n == -1: # cpu
+            model_state, best_result_info = torch.load(f,map_location=lambda storage, loc: storage)
+        elif _GPU_n != None:
             model_state, best_result_info = torch.load(f,map_location=lambda storage, loc: storage.cuda(_GPU_n))
         else:
             model_state, best_result_info = torch.load(f)